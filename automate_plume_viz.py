@@ -16,8 +16,8 @@ from zipfile import ZipFile
 import cv2 as cv
 from PIL import Image, ImageFont, ImageDraw
 from utils import subprocess_check
-from pardumpdump_util import findInFolder, create_multisource_bin
-from cached_hysplit_run_lib import getMultiHourDispersionRunsParallel, parse_eastern, HysplitModelSettings, InitdModelType
+from pardumpdump_util import findInFolder, find_pardump, create_multisource_bin, check_source_split
+from cached_hysplit_run_lib import planMultiHourDispersionRuns, DispersionRunScheduler, DispersionSourceGroup, parse_eastern, HysplitModelSettings, InitdModelType
 
 
 def exec_ipynb(filename_or_url):
@@ -174,8 +174,40 @@ def generate_metadata(start_d, end_d, video_start_delay_hrs=0, url_partition=4,
     return (df_layer, df_share_url, df_img_url, file_name)
 
 
+def plan_simulation_runs(start_time_eastern, sources, emit_time_hrs=1, duration=24, useForecast=False,
+        emission_cycling=False, multi_source=False, pardump_minutes=1, scratch_root=None):
+    """
+    Create the HYSPLIT runs (CachedDispersionRun objects) of all sources for one date, without running them
+
+    Input:
+        (see the docstring of the simulate function)
+
+    Output:
+        a list of runs, grouped by source in the same order as sources (or the runs of all sources together
+        ...if multi_source is True), which is what build_bin expects
+    """
+    dispersion_sources = [source["dispersion_source"] for source in sources]
+    if multi_source:
+        # build_bin tells the sources apart by the first dumped position of each particle
+        check_source_split([(source.lon, source.lat) for source in dispersion_sources], pardump_minutes)
+        dispersion_sources = [DispersionSourceGroup(dispersion_sources)]
+    runs = []
+    for dispersion_source in dispersion_sources:
+        runs += planMultiHourDispersionRuns(
+                dispersion_source,
+                parse_eastern(start_time_eastern),
+                emit_time_hrs,
+                duration,
+                HysplitModelSettings(initdModelType=InitdModelType.ParticleHV, hourlyPardump=False,
+                    emissionCycling=emission_cycling, pardumpMinutes=pardump_minutes),
+                useForecast=useForecast,
+                scratchRoot=scratch_root)
+    return runs
+
+
 def simulate(start_time_eastern, o_file, sources, emit_time_hrs=1, duration=24, filter_ratio=0.8,
-        useForecast=False):
+        useForecast=False, use_pardump=False, memory_budget_bytes=None, emission_cycling=False, multi_source=False,
+        pardump_minutes=1, scratch_root=None):
     """
     Run the HYSPLIT simulation
 
@@ -187,27 +219,51 @@ def simulate(start_time_eastern, o_file, sources, emit_time_hrs=1, duration=24,
         duration: total time (in hours) for the simulation, use 24 for a total day, use 12 for testing
         filter_ratio: the ratio that the points will be dropped (e.g., 0.8 means dropping 80% of the points)
         hysplit_root: the root directory of the hysplit software
+        use_pardump: read the binary PARDUMP files directly instead of the text PARTICLE.DAT files
+        memory_budget_bytes: if not None, the number of bytes that creating the bin file may use
+        emission_cycling: run one HYSPLIT simulation per source that releases the emission every hour,
+        ...instead of one simulation per source and hour (the bin file looks the same)
+        multi_source: release all sources in the same HYSPLIT simulations, instead of one simulation per source
+        ...(raises ValueError if sources are so close that a particle can drift nearer another source before its first dump)
+        pardump_minutes: minutes between particle dumps, which divides 60; the bin file keeps about one position
+        ...every 10 minutes, so 10 avoids writing and parsing dumps that are thrown away, but it is also the
+        ...HYSPLIT integration time step, so trajectories near the sources are less accurate than with 1
+        scratch_root: if not None, a folder on a local disk (e.g., "/dev/shm/hysplit") where the HYSPLIT simulations
+        ...run before their results are copied to the cache, so that the particle dumps are not written over the network
     """
     print("="*100)
     print("="*100)
     print("start_time_eastern: %s" % start_time_eastern)
     print("o_file: %s" % o_file)
 
-    # Check and make sure that the o_file path is created
-    check_and_create_dir(o_file)
-
     # Run simulation and get the folder list (the generated files are cached)
-    path_list = []
-    for source in sources:
-        path_list += getMultiHourDispersionRunsParallel(
-                source["dispersion_source"],
-                parse_eastern(start_time_eastern),
-                emit_time_hrs,
-                duration,
-                HysplitModelSettings(initdModelType=InitdModelType.ParticleHV, hourlyPardump=False),
-                useForecast=useForecast)
+    # The runs of all sources share one queue, so that a source does not wait for the slowest run of another source
+    runs = plan_simulation_runs(start_time_eastern, sources, emit_time_hrs=emit_time_hrs, duration=duration,
+            useForecast=useForecast, emission_cycling=emission_cycling, multi_source=multi_source,
+            pardump_minutes=pardump_minutes, scratch_root=scratch_root)
+    scheduler = DispersionRunScheduler()
+    scheduler.submitGroup(o_file, runs)
+    path_list = scheduler.shutdown()[0]
+
+    build_bin(o_file, sources, path_list, filter_ratio=filter_ratio, use_pardump=use_pardump,
+            memory_budget_bytes=memory_budget_bytes, multi_source=multi_source)
+
+
+def build_bin(o_file, sources, path_list, filter_ratio=0.8, use_pardump=False, memory_budget_bytes=None,
+        multi_source=False, max_workers=None):
+    """
+    Create the bin file from the completed HYSPLIT runs of one date
+
+    Input:
+        path_list: the folders of the runs, grouped by source in the same order as sources (see plan_simulation_runs)
+        max_workers: the number of processes that parse the particle files (see create_multisource_bin)
+        (for other input parameters, see the docstring of the simulate function)
+    """
     print("len(path_list)=%d" % len(path_list))
 
+    # Check and make sure that the o_file path is created
+    check_and_create_dir(o_file)
+
     # Save pdump text files (the generated files are cached)
     # pdump_txt_list = []
     # for folder in path_list:
@@ -226,7 +282,10 @@ def simulate(start_time_eastern, o_file, sources, emit_time_hrs=1, duration=24,
 
     traj_file_list = []
     for folder in path_list:
-        traj = findInFolder(folder,"PARTICLE.DAT")
+        if use_pardump:
+            traj = find_pardump(folder)
+        else:
+            traj = findInFolder(folder,"PARTICLE.DAT")
         traj_file_list.append(traj)
     print("len(traj_file_list)=%d" % len(traj_file_list))
 
@@ -246,7 +305,12 @@ def simulate(start_time_eastern, o_file, sources, emit_time_hrs=1, duration=24,
     cmaps = [source["color"] for source in sources]
     filter_out_ratios = [source["filter_out"] for source in sources] if "filter_out" in sources[0] else filter_ratio
     print("Creating %s" % o_file)
-    create_multisource_bin(traj_file_list, o_file, len(sources), cmaps, filter_out_ratios=filter_out_ratios)
+    source_lonlats = None
+    if multi_source:
+        # Every run holds all sources, which are told apart by their locations
+        source_lonlats = [(source["dispersion_source"].lon, source["dispersion_source"].lat) for source in sources]
+    create_multisource_bin(traj_file_list, o_file, len(sources), cmaps, filter_out_ratios=filter_out_ratios,
+            memory_budget_bytes=memory_budget_bytes, source_lonlats=source_lonlats, max_workers=max_workers)
     print("Created %s" % o_file)
     if os.path.isfile(o_file):
         os.chmod(o_file, 0o777)
@@ -272,16 +336,16 @@ def is_url_valid(url):
         return False
 
 
-def simulate_worker(start_time_eastern, o_file, sources, emit_time_hrs, duration, filter_ratio, o_url, useForecast=False):
+def is_bin_done(o_file, o_url):
     """
-    The parallel worker for hysplit simulation
+    Check if the bin file of a simulation was already created
 
     Input:
-        o_url: if not None, check if the URL for the particle file already exists in the remote server
-        (for other input parameters, see the docstring of the simulate function)
+        o_file: the local path of the bin file (it is written gzipped as o_file + ".gz")
+        o_url: if not None, the URL where the bin file is published
     """
     # Skip if the file exists in local
-    if os.path.isfile(o_file):
+    if os.path.isfile(o_file) or os.path.isfile(o_file + ".gz"):
         print("File exists in local %s" % o_file)
         return True
 
@@ -290,17 +354,7 @@ def simulate_worker(start_time_eastern, o_file, sources, emit_time_hrs, duration
         print("File exists in remote %s" % o_url)
         return True
 
-    # Perform HYSPLIT model simulation
-    try:
-        simulate(start_time_eastern, o_file, sources,
-                emit_time_hrs=emit_time_hrs, duration=duration, filter_ratio=filter_ratio, useForecast=useForecast)
-        return True
-    except Exception:
-        print("-"*60)
-        print("Error when creating %s" % o_file)
-        traceback.print_exc()
-        print("-"*60)
-        return False
+    return False
 
 
 def get_frames(df_img_url, dir_p="data/rgb/", num_try=0, num_workers=4):
@@ -11,7 +11,9 @@ then
 else
   echo "Usage examples:"
   echo "sh bg.sh python main.py genetate_earthtime_data"
+  echo "sh bg.sh python main.py plan_hysplit"
   echo "sh bg.sh python main.py run_hysplit"
+  echo "sh bg.sh python main.py work_hysplit 1"
   echo "sh bg.sh python main.py download_video_frames"
   echo "sh bg.sh python main.py create_all_videos"
   echo "sh bg.sh python main.py generate_plume_viz_json"
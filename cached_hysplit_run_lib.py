@@ -4,10 +4,13 @@ This code was taken and edited from the following path on hal21 server (on Oct 2
 """
 
 
-import sys, datetime, dateutil, enum, hashlib, io, os, threading, traceback, glob, gzip, shutil, subprocess
+import sys, datetime, dateutil, enum, hashlib, io, json, math, os, re, socket, threading, time, traceback, glob, gzip, shutil, subprocess
+import concurrent.futures
 from jinja2 import Template
 from filelock import FileLock
-from utils import SimpleThreadPoolExecutor, download_file, subprocess_check
+from utils import SimpleThreadPoolExecutor, subprocess_check, publish_directory, run_streaming, SubprocessTimeout
+from met_file_lib import getMetFileManager
+from dispersion_cache_lib import getDispersionCacheManifest, flushAllLookups, folderSize, TELEMETRY_FILENAME
 import pandas as pd
 import numpy as np
 
@@ -65,15 +68,28 @@ class InitdModelType(enum.Enum):
 
 
 class HysplitModelSettings:
+    """
+    emissionCycling -- if True, release the emission of every hour within one HYSPLIT run that cycles
+    ...the emission (QCYCLE in SETUP.CFG), instead of one run per emission hour
+    pardumpMinutes -- minutes between particle dumps, ignored if hourlyPardump is True
+    ...this is also the fixed integration time step (DELT), so it must divide an hour, and values above 1 trade
+    ...accuracy near the sources (particles take longer steps through the wind field) for less output;
+    ...60 is not allowed, since hourlyPardump dumps hourly with 1 minute steps
+    """
     def __init__(self,
                  initdModelType=InitdModelType.ParticleHV,
-                 hourlyPardump=False):
+                 hourlyPardump=False,
+                 emissionCycling=False,
+                 pardumpMinutes=1):
         if isinstance(initdModelType, int):
             print(
                 'Consider using InitdModelType enum for HysplitModelSettings')
             initdModelType = InitdModelType(int)
         self.initdModelType = initdModelType
         self.hourlyPardump = hourlyPardump
+        self.emissionCycling = emissionCycling
+        assert(pardumpMinutes >= 1 and 60 % pardumpMinutes == 0 and pardumpMinutes != 60)
+        self.pardumpMinutes = int(pardumpMinutes)
 
     def __str__(self):
         ret = '<HMS'
@@ -81,8 +97,10 @@ class HysplitModelSettings:
         if self.hourlyPardump:
             pardumpMins = 60
         else:
-            pardumpMins = 1
+            pardumpMins = self.pardumpMinutes
         ret += ' pardump=%dm' % pardumpMins
+        if self.emissionCycling:
+            ret += ' cycling'
         ret += '>'
         return ret
 
@@ -115,6 +133,41 @@ class DispersionSource:
             path += '_%g' % self.areaSqM
         return path
 
+    def sourceList(self):
+        """The sources released in a run of this source (see DispersionSourceGroup)"""
+        return [self]
+
+    def toJson(self):
+        return {'name': self.name, 'lat': self.lat, 'lon': self.lon, 'minHeight': self.minHeight,
+                'maxHeight': self.maxHeight, 'areaSqM': self.areaSqM}
+
+    def __repr__(self):
+        return self.name
+
+
+class DispersionSourceGroup:
+    """
+    Several DispersionSources released in one HYSPLIT run, which reads the met files once for all of them
+    Each source adds its min and max height as two source locations to the CONTROL file,
+    ...and the particles are split back out per source by their position at release
+    ...(see pardumpdump_util.particle_group_file_to_bin)
+    """
+    def __init__(self, sources):
+        assert(len(sources) > 0)
+        self.sources = list(sources)
+        self.name = '+'.join(source.name for source in self.sources)
+
+    def cachePath(self):
+        # The key covers every source in order, since the particles are assigned to sources in this order
+        key = ';'.join(source.cachePath() for source in self.sources)
+        return 'group%d_%s' % (len(self.sources), hashlib.sha1(key.encode()).hexdigest()[:16])
+
+    def sourceList(self):
+        return self.sources
+
+    def toJson(self):
+        return [source.toJson() for source in self.sources]
+
     def __repr__(self):
         return self.name
 
@@ -125,6 +178,26 @@ assert(DispersionSource(name='Test', lat=40.123456789, lon=-79.123456789,
     minHeight=10, maxHeight=50, areaSqM=100).cachePath() == '40.123457,-79.123457_10-50_100')
 
 
+# Particles released by one emission of one source, and the most hours a particle is followed
+NUMPAR_PER_EMISSION = 2500
+MAXPAR_PER_EMISSION = 25000
+MAX_PARTICLE_AGE_HRS = 24
+
+# Limits of one hycs_std process per hour that one emission of one source is simulated (see emissionHours),
+# ...up to the caps; a process that exceeds them is stuck, so it is killed and run again, up to HYSPLIT_ATTEMPTS times in all
+HYSPLIT_WALL_SECS_PER_HOUR = 900
+HYSPLIT_CPU_SECS_PER_HOUR = 600
+HYSPLIT_MAX_WALL_SECS = 12 * 3600
+HYSPLIT_MAX_CPU_SECS = 8 * 3600
+HYSPLIT_ATTEMPTS = 2
+
+# Progress lines that hycs_std prints as the simulation advances, e.g., " Percent complete:  42.0"
+HYSPLIT_PROGRESS_PATTERN = re.compile(r'percent complete\W*([\d.]+)', re.IGNORECASE)
+
+# Files written by hycs_std, deleted before a stuck run is run again
+HYSPLIT_OUTPUT_PATTERNS = ['cdump', 'PARDUMP*', 'PARTICLE*', 'MESSAGE*', 'WARNING*']
+
+
 class CachedDispersionRun:
     """
     Input:
@@ -132,14 +205,18 @@ class CachedDispersionRun:
         runStartLocal -- beginning of emission, in local timezone
         emitTime -- length of emission, in hours
         runTime -- length of simulation, in hours
+        qcycleHrs -- if set, repeat the emission every qcycleHrs hours until the end of the run,
+        ...and drop particles older than MAX_PARTICLE_AGE_HRS (see HysplitModelSettings.emissionCycling)
         fileName -- file name of binary results file
         hysplit_root -- the root directory of the hysplit software
+        scratchRoot -- if set, a folder on a local disk (e.g., tmpfs or SSD) where HYSPLIT runs and writes
+        ...its particle dumps, instead of a temp folder in the cache; the results are then copied to the cache
     """
     def __init__(self, source, runStartLocal, emitTimeHrs, runTimeHrs, hysplitModelSettings,
                  fileName='cdump', hysplit_root='/projects/hysplit.v5.1.0/', verbose=False,
                  dispersionCachePath='/projects/earthtime/air-src/linRegModel/dispersionCache',
                  hrrrDirPath='/projects/earthtime/air-data/hrrr',
-                 useForecast=False):
+                 useForecast=False, qcycleHrs=None, scratchRoot=None):
         try:
             self.dispersionCachePath = dispersionCachePath
             self.hrrrDirPath = hrrrDirPath
@@ -167,6 +244,9 @@ class CachedDispersionRun:
 
             self.initdModelType = hysplitModelSettings.initdModelType
 
+            assert(qcycleHrs is None or qcycleHrs >= emitTimeHrs)
+            self.qcycleHrs = qcycleHrs
+
             self.verbose= verbose
             if self.verbose:
                 sys.stdout.write(msg + '\n')
@@ -174,6 +254,7 @@ class CachedDispersionRun:
             self.logfile = None
 
             self.hourlyPardump = hysplitModelSettings.hourlyPardump
+            self.pardumpMinutes = hysplitModelSettings.pardumpMinutes
 
             if not os.path.exists(self.path()) and self.hourlyPardump:
                 self.hourlyPardump = False
@@ -195,13 +276,27 @@ class CachedDispersionRun:
         self.hysplitLoc = hysplit_root + "exec/"
         self.runHr = int(runTimeHrs)
         self.runMin = int((runTimeHrs - int(runTimeHrs))*60)
-        
-        if useForecast:
-            self.log('Using forecast met files...')
-            self.fNames = self.fetchForecastFiles()
-        else:
-            self.log('Using reanalysis met files...')
-            self.fNames = self.fetchWeatherFiles()
+
+        # Met files are resolved (and possibly unzipped or downloaded) only when the run needs them, see fNames
+        self.useForecast = useForecast
+        self.scratchRoot = scratchRoot
+        # Hours simulated by the running hycs_std process, see parseProgress
+        self.simulatedHrs = 0
+        self._fNames = None
+        self._fNamesLock = threading.Lock()
+
+    @property
+    def fNames(self):
+        """Paths of the met files of this run, fetched on first use"""
+        with self._fNamesLock:
+            if self._fNames is None:
+                if self.useForecast:
+                    self.log('Using forecast met files...')
+                    self._fNames = self.fetchForecastFiles()
+                else:
+                    self.log('Using reanalysis met files...')
+                    self._fNames = self.fetchWeatherFiles()
+            return self._fNames
 
     def assertComplete(self):
         """Assert this run has all files associated with successful completion, e.g. cdump"""
@@ -211,16 +306,60 @@ class CachedDispersionRun:
         if errs:
             raise Exception('Errors found in HYSPLIT directory %s: %s' % (self.path(), '; '.join(errs)))
 
-    def findOrRun(self):
+    def manifest(self):
+        return getDispersionCacheManifest(self.dispersionCachePath)
+
+    def isComplete(self, countLookup=True, verify=False):
+        """
+        Pure cache lookup: True if this run was already completed, without touching met files
+        The manifest is checked first, so that recorded runs are not stat-ed (unless verify is True),
+        ...but a miss reads its row from the manifest again and stats its cdump
+        countLookup -- count the lookup for the hit rate in the manifest
+        verify -- also check that the folder of a recorded run exists (it may have been garbage collected
+                  by another process since the manifest was read), use it before reading the run
+        """
+        manifest = self.manifest()
+        complete = manifest.isRecorded(self.localPath(), refresh=True)
+        if complete and verify and not os.path.exists(self.cdumpPath()):
+            manifest.forgetRun(self.localPath())
+            complete = False
+        elif not complete and os.path.exists(self.cdumpPath()):
+            # Completed before the manifest existed
+            self.recordInManifest()
+            complete = True
+        if countLookup:
+            manifest.recordLookup(complete, self.localPath())
+        return complete
+
+    def recordInManifest(self):
+        try:
+            self.manifest().recordRun(self.localPath())
+        except Exception as e:
+            # The manifest can be rebuilt from the cache folder, so a failure here must not fail the run
+            self.log('Received exception %s while recording %s in the dispersion cache manifest' % (e, self.path()))
+
+    def findOrRun(self, cancelEvent=None):
+        """cancelEvent -- if not None, a threading.Event that kills the hycs_std process when set"""
+        # Fast path for cached runs: met files are not resolved unless run() is needed
+        if self.isComplete(verify=True):
+            self.vlog('Hysplit run at location %s already complete.' % self.path())
+            return(self.path())
         if not os.path.exists(self.path()):
-            self.run()
+            try:
+                self.run(cancelEvent)
+            except Exception:
+                if self.scratchRoot:
+                    # Nothing retries a failed run, so free its scratch folder (which may be in memory) now;
+                    # ...it is only used by this thread, so it is safe to delete after the lock is released
+                    self.discardScratch()
+                raise
             self.assertComplete()
         else:
             self.vlog('Hysplit run at location %s already complete.' % self.path())
             self.assertComplete()
         return(self.path())
 
-    def run(self):
+    def run(self, cancelEvent=None):
         """
         Called internally.
         Make sure we aren't already completed or in progress somewhere else before calling this method?
@@ -241,38 +380,77 @@ class CachedDispersionRun:
             if os.path.exists(self.tmpPath()):
                 self.log('Deleting old temp directory %s' % self.tmpPath())
                 shutil.rmtree(self.tmpPath())
+            if self.scratchRoot:
+                # Scratch folders of this run are local, so while we hold the lock the ones left on this host are stale
+                scratchBase = os.path.join(self.scratchRoot, self.localPath())
+                for stalePath in glob.glob(glob.escape(scratchBase) + '_*.tmp'):
+                    # Skip the scratch folders of runs whose names extend this one (e.g., with a _D10 suffix)
+                    if not re.match(r'^_\d+_\d+\.tmp$', stalePath[len(scratchBase):]):
+                        continue
+                    self.log('Deleting old scratch directory %s' % stalePath)
+                    shutil.rmtree(stalePath)
             # Short circuit if this is the second process to acquire the FileLock, and thus the run is complete
             if os.path.exists(os.path.join(self.path(),'cdump')):
                 return(self.path())
 
-            os.makedirs(self.tmpPath())
-            self.logfile = open(self.tmpPath() + '/log.txt', 'w')
+            runStart = time.time()
+            os.makedirs(self.workPath())
+            self.logfile = open(self.workPath() + '/log.txt', 'w')
             self.makeSetup()
             self.makeASC()
-            self.makeControl()
-            self.vlog('Running dispersion, path %s, settings %s' % (self.tmpPath(), self.settingsAsString()))
+            self.makeSourcesJson()
+            # Keep the met files unzipped while HYSPLIT reads them; afterwards they may be evicted
+            metWaitStart = time.time()
+            self.acquireWeatherFiles()
+            metWaitSecs = time.time() - metWaitStart
             try:
-                # TODO: have the HYSPLIT subprocess chdir instead of the python parent
-                self.runDispersion()
-                self.vlog('SUCCESS for dispersion run: %s' % self.tmpPath())
-            except Exception as e:
-                self.log('Received exception %s during DispersionRun' % e)
-                self.log('Run directory: %s' % self.tmpPath())
-                self.log('Settings: %s' % self.settingsAsString())
-                raise
+                self.makeControl()
+                self.vlog('Running dispersion, path %s, settings %s' % (self.workPath(), self.settingsAsString()))
+                try:
+                    # TODO: have the HYSPLIT subprocess chdir instead of the python parent
+                    result = self.runDispersion(cancelEvent)
+                    self.vlog('SUCCESS for dispersion run: %s' % self.workPath())
+                except Exception as e:
+                    self.log('Received exception %s during DispersionRun' % e)
+                    self.log('Run directory: %s' % self.workPath())
+                    self.log('Settings: %s' % self.settingsAsString())
+                    raise
+            finally:
+                self.releaseWeatherFiles()
+            self.makeTelemetryJson(result, metWaitSecs, time.time() - runStart)
             try:
-                os.rename(self.tmpPath(), self.path())
-                self.vlog('Successful rename from %s to %s' % (self.tmpPath(),self.path()))
+                if self.scratchRoot:
+                    self.logfile.close()
+                    self.logfile = None
+                publish_directory(self.workPath(), self.path())
+                if self.scratchRoot:
+                    self.logfile = open(self.path() + '/log.txt', 'a')
+                self.vlog('Successful publish from %s to %s' % (self.workPath(),self.path()))
+                self.recordInManifest()
             except Exception as e:
                 self.log('Received exception %s during rename' % e)
-                self.log('Run directory: %s' % self.tmpPath())
+                self.log('Run directory: %s' % self.workPath())
                 self.log('Settings: %s' % self.settingsAsString())
                 raise
-        for fname in self.fNames:
-            if os.path.exists(fname + '.gz') and os.path.exists(fname):
-                os.remove(fname)
         self.assertComplete()
 
+    def discardScratch(self):
+        """Copy the logs of a failed run from its scratch folder to its temp folder in the cache, and delete the scratch folder"""
+        if self.logfile:
+            self.logfile.close()
+            self.logfile = None
+        try:
+            if not os.path.exists(self.workPath()):
+                return
+            os.makedirs(self.tmpPath(), exist_ok=True)
+            for name in ['log.txt', 'MESSAGE', 'WARNING']:
+                if os.path.exists(os.path.join(self.workPath(), name)):
+                    shutil.copy(os.path.join(self.workPath(), name), self.tmpPath())
+            shutil.rmtree(self.workPath())
+            self.log('Deleted scratch directory %s, logs kept in %s' % (self.workPath(), self.tmpPath()))
+        except OSError as e:
+            self.log('Received exception %s while deleting scratch directory %s' % (e, self.workPath()))
+
     def log(self, *args, include_stdout=True):
         prefix = '%s %s' % (os.getpid(), threading.get_ident())
         buf = io.StringIO()
@@ -288,10 +466,35 @@ class CachedDispersionRun:
         """Log only to stdout if in verbose mode"""
         self.log(*args, include_stdout=self.verbose)
 
-    def runDispersion(self):
+    def runDispersion(self, cancelEvent=None):
+        """Run hycs_std in workPath, streaming its output to log.txt, and retry it if it gets stuck"""
         hyString = self.hysplitLoc + 'hycs_std'
-        #out = subprocess.run(hyString, shell=True)
-        subprocess_check(hyString, cwd=self.tmpPath(), verbose=True)
+        for attempt in range(1, HYSPLIT_ATTEMPTS + 1):
+            self.vlog('%s (attempt %d of %d)' % (hyString, attempt, HYSPLIT_ATTEMPTS))
+            self.simulatedHrs = 0
+            try:
+                # A simulated hour moves every live particle, so runs with more particles take longer
+                return run_streaming([hyString], log_file=self.logfile, cwd=self.workPath(),
+                        wall_timeout_secs=min(HYSPLIT_WALL_SECS_PER_HOUR * self.emissionHours(), HYSPLIT_MAX_WALL_SECS),
+                        cpu_timeout_secs=min(HYSPLIT_CPU_SECS_PER_HOUR * self.emissionHours(), HYSPLIT_MAX_CPU_SECS),
+                        cancel_event=cancelEvent, on_line=self.parseProgress)
+            except SubprocessTimeout as e:
+                self.log('Received exception %s after %g simulated hours' % (e, self.simulatedHrs))
+                if attempt == HYSPLIT_ATTEMPTS:
+                    raise
+                for pattern in HYSPLIT_OUTPUT_PATTERNS:
+                    for outputPath in glob.glob(os.path.join(glob.escape(self.workPath()), pattern)):
+                        os.remove(outputPath)
+
+    def parseProgress(self, line):
+        """Update simulatedHrs from a line of hycs_std output, logging each new simulated hour"""
+        m = HYSPLIT_PROGRESS_PATTERN.search(line)
+        if not m:
+            return
+        simulatedHrs = min(float(m.group(1)), 100) / 100 * self.runTimeHrs
+        if int(simulatedHrs) > int(self.simulatedHrs):
+            self.vlog('Simulated %d of %d hours' % (int(simulatedHrs), self.runTimeHrs))
+        self.simulatedHrs = simulatedHrs
 
     def getUncompressedPardump(self):
         """Get the path to the uncompressed PARDUMP file"""
@@ -310,12 +513,16 @@ class CachedDispersionRun:
 
     def settingsAsString(self):
         ret = '{'
-        ret += ','.join(['sourceLoc:[%.6f,%.6f]' % (self.source.lat, self.source.lon),
-                         'sourceHeight:[%g,%g]' % (self.source.minHeight, self.source.maxHeight),
-                         'runStartLocal:"%s"' % self.runStartLocal,
+        settings = []
+        for source in self.source.sourceList():
+            settings += ['sourceLoc:[%.6f,%.6f]' % (source.lat, source.lon),
+                         'sourceHeight:[%g,%g]' % (source.minHeight, source.maxHeight)]
+        ret += ','.join(settings +
+                        ['runStartLocal:"%s"' % self.runStartLocal,
                          'emitTimeHrs:%g' % self.emitTimeHrs,
                          'runTimeHrs:%g' % self.runTimeHrs,
-                         'initdModelType:%s' % repr(self.initdModelType)])
+                         'initdModelType:%s' % repr(self.initdModelType)] +
+                        (['qcycleHrs:%g' % self.qcycleHrs] if self.qcycleHrs else []))
         ret += '}'
         return ret
 
@@ -323,12 +530,23 @@ class CachedDispersionRun:
         """Compute temp path unique to this instance of Python, based on PID and thread ID"""
         return '%s_%d_%d.tmp' % (self.path(), os.getpid(), threading.get_ident())
 
+    def workPath(self):
+        """Folder where HYSPLIT runs: tmpPath, or a folder under scratchRoot (published to path by run)"""
+        if self.scratchRoot:
+            return '%s_%d_%d.tmp' % (os.path.join(self.scratchRoot, self.localPath()), os.getpid(), threading.get_ident())
+        return self.tmpPath()
+
     def localPath(self):
         """Compute cache pathname relative to dispersionCachePath parent"""
         ret = os.path.join(self.source.cachePath(), '%s_%gh_%gh_%g' % (self.runStartLocal.strftime('%Y%m%d_%H%M%S%z'), self.emitTimeHrs, self.runTimeHrs, self.initdModelType.value))
         if self.hourlyPardump:
             # Minutely (P1) pardump is assumed if this field doesn't exists, for backwards compatibility
             ret += '_P60'
+        elif self.pardumpMinutes != 1:
+            # D for the time step, since it differs from the 1 minute step of P60
+            ret += '_D%d' % self.pardumpMinutes
+        if self.qcycleHrs:
+            ret += '_Q%g' % self.qcycleHrs
         return ret
 
     def path(self):
@@ -405,36 +623,32 @@ class CachedDispersionRun:
             os.unlink(psPath)
 
     def fetchWeatherFiles(self):
-        hrrrDir = os.path.abspath(self.hrrrDirPath)
-        fNames = []
-        # Date when NOAA archive format changed
-        isReformat = self.runStartUtc > datetime.datetime(2019,7,22,0,0,0,0,dateutil.tz.tzutc())
-        for dt in self.computeTimes():
-            name = dt.strftime('hysplit.%Y%m%d.%Hz.hrrra')
-            fullPath = hrrrDir + '/' + name
-            if not os.path.exists(fullPath):
-                if os.path.exists(fullPath + '.gz'):
-                    with gzip.open(fullPath + '.gz', 'rb') as f_in:
-                        tmpPath = f'{fullPath}_{os.getpid()}_{threading.get_ident()}.tmp'
-                        with open(tmpPath, 'wb') as f_out:
-                            try:
-                                self.log("Unzipping " + fullPath)
-                                shutil.copyfileobj(f_in, f_out)
-                            except EOFError:
-                                self.log("Unzip failed, redownloading " + fullPath)
-                                os.remove(fullPath + '.gz')
-                                os.remove(tmpPath)
-                        os.rename(tmpPath,fullPath)
-                if isReformat:
-                    linkEnd = dt.strftime('%Y%m%d_%H-') + str(dt.hour + 5).zfill(2) + '_hrrr'
-                    fileDownloaded = download_file('https://storage.googleapis.com/high-resolution-rapid-refresh/noaa_arl_formatted/' + linkEnd, fullPath)
-                    if not fileDownloaded:
-                        self.log('File not found in the Google Cloud Platform HRRR archive. Trying ARL FTP server... ')
-                        download_file('ftp://arlftp.arlhq.noaa.gov/pub/archives/hrrr/' + linkEnd, fullPath)
-                else:
-                    download_file('ftp://arlftp.arlhq.noaa.gov/pub/archives/hrrr.v1/' + name, fullPath)
-            fNames.append(fullPath)
-        return fNames
+        """Unzip or download the HRRR files of this run; each file is fetched once even if other runs need it too"""
+        manager = getMetFileManager(self.hrrrDirPath)
+        return [manager.fetch(dt) for dt in self.computeTimes()]
+
+    def acquireWeatherFiles(self):
+        """Fetch the met files of this run and keep them unzipped until releaseWeatherFiles"""
+        if self.useForecast:
+            return self.fNames
+        with self._fNamesLock:
+            self._fNames = getMetFileManager(self.hrrrDirPath).acquire(self.computeTimes())
+            return self._fNames
+
+    def releaseWeatherFiles(self):
+        """Let the met file manager delete the unzipped met files of this run when they exceed its disk budget"""
+        if not self.useForecast and self._fNames is not None:
+            getMetFileManager(self.hrrrDirPath).release(self._fNames)
+
+    def prefetchWeatherFiles(self):
+        """Start fetching the HRRR files of this run in the background"""
+        if not self.useForecast:
+            getMetFileManager(self.hrrrDirPath).prefetch(self.computeTimes())
+
+    def releasePrefetchedWeatherFiles(self):
+        """Let the files prefetched for this run be evicted, if it finished without acquiring them (e.g., it failed)"""
+        if not self.useForecast:
+            getMetFileManager(self.hrrrDirPath).releasePrefetched(self.computeTimes())
 
     def fetchForecastFiles(self):
         #no download for now
@@ -465,33 +679,95 @@ class CachedDispersionRun:
             t = t + datetime.timedelta(hours = 6)
         return dtimes
 
+    def particleScale(self):
+        """How many times as many particles can be alive as in a run of one source and one emission"""
+        scale = len(self.source.sourceList())
+        if self.qcycleHrs:
+            # Particles of every emission cycle are alive at the same time (up to KHMAX hours)
+            scale *= int(math.ceil(min(self.runTimeHrs, MAX_PARTICLE_AGE_HRS) / self.qcycleHrs))
+        return scale
+
+    def emissionHours(self):
+        """
+        The simulated hours of all emissions of all sources, summed over their lifetimes (up to MAX_PARTICLE_AGE_HRS)
+        This is the work of a run in units of one emission simulated for one hour
+        """
+        hrs = self.runTimeHrs
+        if self.qcycleHrs:
+            emissionStarts = range(int(math.ceil(self.runTimeHrs / self.qcycleHrs)))
+            hrs = sum(min(self.runTimeHrs - i * self.qcycleHrs, MAX_PARTICLE_AGE_HRS) for i in emissionStarts)
+        return hrs * len(self.source.sourceList())
+
     def makeSetup(self):
         """See hysplit users guide section "Particle File Output Options" for ndump and ncycl"""
+        delt = 1
         if self.hourlyPardump:
             # dump after every 1 hour, cycling every 1 hour because ncycl = 1
             ndump = 1
         else:
-            # dump every 1 minute until entire run is done
+            # dump every time step of pardumpMinutes minutes until entire run is done
+            # ...a longer time step is a coarser integration, not only fewer dumps (see HysplitModelSettings)
             ndump = -self.runTimeHrs
+            delt = self.pardumpMinutes
+
+        # Release as many particles per source as a run of a single source does
+        numpar = NUMPAR_PER_EMISSION * len(self.source.sourceList())
+        maxpar = MAXPAR_PER_EMISSION * self.particleScale()
 
         templ = Template(
             """&SETUP
-{#          #}NUMPAR = 2500,
-{#          #}MAXPAR = 25000,
-{#          #}INITD ={{run.initdModelType.value}},
+{#          #}NUMPAR = {{numpar}},
+{#          #}MAXPAR = {{maxpar}},
+{% if run.qcycleHrs %}{#          #}QCYCLE = {{run.qcycleHrs}},
+{#          #}KHMAX = {{khmax}},
+{% endif %}{#          #}INITD ={{run.initdModelType.value}},
 {#          #}CONAGE = 1,
 {#          #}KSPL = 1,
 {#          #}ICHEM = 8,
 {#          #}ndump = {{ndump}},
 {#          #}ncycl = 1,
-{#          #}delt = 1,
+{#          #}delt = {{delt}},
 {#          #}poutf = 'PARDUMP.h{{run.runStartLocal.hour}}',
 {#          #}/\n""", keep_trailing_newline=1)
-        content = templ.render(run=self, ndump=ndump)
-        cFile = open(self.tmpPath() + '/SETUP.CFG', 'w')
+        content = templ.render(run=self, ndump=ndump, delt=delt, numpar=numpar, maxpar=maxpar, khmax=MAX_PARTICLE_AGE_HRS)
+        cFile = open(self.workPath() + '/SETUP.CFG', 'w')
         cFile.write(content)
         cFile.close()
 
+    def makeSourcesJson(self):
+        """Record the sources of a DispersionSourceGroup run in order, since its cache path is a hash"""
+        if isinstance(self.source, DispersionSourceGroup):
+            with open(self.workPath() + '/sources.json', 'w') as f:
+                json.dump(self.source.toJson(), f, indent=2)
+
+    def makeTelemetryJson(self, result, metWaitSecs, runSecs):
+        """
+        Record the resources used by this run in telemetry.json (see printTelemetryReport in dispersion_cache_lib.py)
+        result -- the SubprocessResult of the hycs_std process that completed
+        """
+        telemetry = {
+            'sourcePath': self.source.cachePath(),
+            'runStartLocal': self.runStartLocal.isoformat(),
+            'emitTimeHrs': self.emitTimeHrs,
+            'runTimeHrs': self.runTimeHrs,
+            'initd': self.initdModelType.value,
+            'pardumpMinutes': 60 if self.hourlyPardump else self.pardumpMinutes,
+            'qcycleHrs': self.qcycleHrs,
+            'numSources': len(self.source.sourceList()),
+            'hostname': socket.gethostname(),
+            'wallSecs': result.wall_secs,
+            'userCpuSecs': result.rusage.ru_utime,
+            'sysCpuSecs': result.rusage.ru_stime,
+            # Not ru_maxrss, which includes the memory of this process that hycs_std was forked from
+            'peakRssBytes': result.peak_rss_bytes,
+            'metWaitSecs': metWaitSecs,
+            'runSecs': runSecs,
+            'outputBytes': folderSize(self.workPath()),
+            'completedAt': time.time(),
+        }
+        with open(os.path.join(self.workPath(), TELEMETRY_FILENAME), 'w') as f:
+            json.dump(telemetry, f, indent=1)
+
     def makeASC(self):
         templ = Template(
             """-90.0   -180.0  lat/lon of lower left corner
@@ -500,16 +776,18 @@ class CachedDispersionRun:
 {#          #}2               default land use category
 {#          #}0.2             default roughness length (m)
 {#          #}'"""+self.hysplit_root+"""bdyfiles/'  directory of files""")
-        cFile = open(self.tmpPath() + '/ASCDATA.CFG','w')
+        cFile = open(self.workPath() + '/ASCDATA.CFG','w')
         cFile.write(templ.render(run=self))
         cFile.close()
 
     def makeControl(self):
         templ = Template(
             """{{ run.runStartUtc.strftime('%y %m %d %H %M') }} #1: run start time in YY MM DD HH MN (UTC)
-{#          #}2 #2: NUMBER OF SOURCE LOCATIONS
-{#          #}{% for height in (run.source.minHeight, run.source.maxHeight) -%}
-{#          #}{{ run.source.lat }} {{ run.source.lon }} {{ height }} 1 {{ run.source.areaSqM }} #3: SOURCE LATITUDE | LONGITUDE | HEIGHT(m-agl) | EMISSION RATE (per hour) | AREA (sq m)
+{#          #}{{ 2 * len(run.source.sourceList()) }} #2: NUMBER OF SOURCE LOCATIONS
+{#          #}{% for source in run.source.sourceList() -%}
+{#          #}{% for height in (source.minHeight, source.maxHeight) -%}
+{#          #}{{ source.lat }} {{ source.lon }} {{ height }} 1 {{ source.areaSqM }} #3: SOURCE LATITUDE | LONGITUDE | HEIGHT(m-agl) | EMISSION RATE (per hour) | AREA (sq m)
+{#          #}{%- endfor -%}
 {#          #}{%- endfor -%}
 {#          #}{{ run.runTimeHrs }} #4: TOTAL RUN TIME (hours)
 {#          #}0 #5: VERTICAL MOTION (USE MODEL VERTICAL VELOCITY)
@@ -541,7 +819,7 @@ class CachedDispersionRun:
 {#          #}0.0 0.0 0.0 #29: WET REMOVAL, ZERO (NO DEPOSITING)
 {#          #}0 #30: RADIOACTIVE DECAY HALF-LIFE (days)
 {#          #}0.0 #31: POLLUTANT RESUSPENSION""")
-        cFile = open(self.tmpPath() + '/CONTROL', 'w')
+        cFile = open(self.workPath() + '/CONTROL', 'w')
         cFile.write(templ.render(run=self, os=os, len=len))
         cFile.close()
 
@@ -556,7 +834,7 @@ class CachedDispersionRun:
         -z: Include zeros
         """
         hyString = self.hysplitLoc + ('con2asc -i%s -s -t -v -x -z' %name)
-        subprocess.run(hyString, cwd=(self.tmpPath()), shell=True)
+        subprocess.run(hyString, cwd=(self.workPath()), shell=True)
 
     def interpolate(self, cdumpFile, outputFile, stationFile):
         #subprocess_check('ls -l %s %s' % (cdumpFile, stationFile), verbose=True)
@@ -613,13 +891,15 @@ def getDispersionRun(source,runStartLocal,emitTimeHrs,runTimeHrs,hysplitModelSet
     run.assertComplete()
     return run
 
-def getMultiHourDispersionRunsParallel(source,runStartLocal,emitTimeHrs,totalRunTimeHrs,
+def planMultiHourDispersionRuns(source,runStartLocal,emitTimeHrs,totalRunTimeHrs,
         hysplitModelSettings,backwardsHrs=0,resolutionHrs=1,
         dispersionCachePath='/projects/earthtime/air-src/linRegModel/dispersionStiltCache',
-        hrrrDirPath='/projects/earthtime/air-data/hrrr',useForecast=False):
-    # TODO: Change to only return
-    # Only used for visualization (currently)
-    # Use threading to produce collection of DispersionRuns over several hours for the same source
+        hrrrDirPath='/projects/earthtime/air-data/hrrr',useForecast=False,scratchRoot=None):
+    """
+    Create the CachedDispersionRuns over several hours for the same source, in hour order, without running them
+    With hysplitModelSettings.emissionCycling, a single run covers all the hours
+    scratchRoot -- see CachedDispersionRun
+    """
     # TODO: Check if resolutionHrs param is redundant with emitTimeHrs (check old linRegLib method). Not urgent as long as both are always 1
 
     if useForecast:
@@ -629,22 +909,194 @@ def getMultiHourDispersionRunsParallel(source,runStartLocal,emitTimeHrs,totalRun
     hysplitStartLocal = runStartLocal - datetime.timedelta(hours=backwardsHrs)
     hysplitRunTimeHrs = totalRunTimeHrs + backwardsHrs
 
+    if hysplitModelSettings.emissionCycling:
+        # One run releases the emission every resolutionHrs hours, and particles are followed for at most
+        # ...MAX_PARTICLE_AGE_HRS hours, like the separate runs below
+        return [CachedDispersionRun(
+            source=source,
+            runStartLocal=hysplitStartLocal,
+            emitTimeHrs=emitTimeHrs,
+            runTimeHrs=hysplitRunTimeHrs,
+            hysplitModelSettings=hysplitModelSettings,
+            dispersionCachePath=dispersionCachePath,
+            hrrrDirPath=hrrrDirPath,
+            useForecast=useForecast,
+            qcycleHrs=resolutionHrs,
+            scratchRoot=scratchRoot
+            )]
+
     hours = list(dateutil.rrule.rrule(dateutil.rrule.HOURLY, interval=resolutionHrs, dtstart=hysplitStartLocal, until=runStartLocal + datetime.timedelta(hours=totalRunTimeHrs-1)))
 
-    # TODO: switch to process pool?
-    maxThreads = 30
-    pool = SimpleThreadPoolExecutor(maxThreads)
+    runs = []
     for i,hour in enumerate(hours):
-        run = CachedDispersionRun(
+        runs.append(CachedDispersionRun(
             source=source,
             runStartLocal=hour,
             emitTimeHrs=emitTimeHrs,
-            runTimeHrs=min(hysplitRunTimeHrs-(i*resolutionHrs),24),
+            runTimeHrs=min(hysplitRunTimeHrs-(i*resolutionHrs),MAX_PARTICLE_AGE_HRS),
             hysplitModelSettings=hysplitModelSettings,
             dispersionCachePath=dispersionCachePath,
             hrrrDirPath=hrrrDirPath,
-            useForecast=useForecast
-            )
+            useForecast=useForecast,
+            scratchRoot=scratchRoot
+            ))
+    return runs
+
+def getMultiHourDispersionRunsParallel(source,runStartLocal,emitTimeHrs,totalRunTimeHrs,
+        hysplitModelSettings,backwardsHrs=0,resolutionHrs=1,
+        dispersionCachePath='/projects/earthtime/air-src/linRegModel/dispersionStiltCache',
+        hrrrDirPath='/projects/earthtime/air-data/hrrr',useForecast=False,scratchRoot=None):
+    # TODO: Change to only return
+    # Only used for visualization (currently)
+    # Use threading to produce collection of DispersionRuns over several hours for the same source
+    # To run many sources or dates, submit their runs to one DispersionRunScheduler instead
+    runs = planMultiHourDispersionRuns(source, runStartLocal, emitTimeHrs, totalRunTimeHrs,
+            hysplitModelSettings, backwardsHrs=backwardsHrs, resolutionHrs=resolutionHrs,
+            dispersionCachePath=dispersionCachePath, hrrrDirPath=hrrrDirPath, useForecast=useForecast,
+            scratchRoot=scratchRoot)
+
+    # TODO: switch to process pool?
+    maxThreads = 30
+    pool = SimpleThreadPoolExecutor(maxThreads)
+    for run in runs:
         pool.submit(run.findOrRun)
-    pathList = pool.shutdown()
+    try:
+        pathList = pool.shutdown()
+    finally:
+        flushAllLookups()
     return pathList
+
+def defaultMaxDispersionJobs():
+    """Each hycs_std process uses one CPU, so run one per CPU"""
+    return os.cpu_count() or 1
+
+class DispersionRunScheduler:
+    """
+    Run the CachedDispersionRuns of many groups (e.g., all sources and hours of one date)
+    ...in a single queue, with at most maxJobs hycs_std processes at the same time
+    Runs are queued in the order their groups are submitted, so the first groups complete first,
+    ...and onComplete(pathList) of a group is called (in one of maxCallbacks threads)
+    ...as soon as all of its runs are complete, while the runs of later groups continue
+    A run that belongs to several groups is only run once
+    Usage:
+        scheduler = DispersionRunScheduler()
+        scheduler.submitGroup('2020-03-30', runs, onComplete=buildBin)
+        results = scheduler.shutdown()
+    """
+    def __init__(self, maxJobs=None, maxCallbacks=1):
+        self.maxJobs = maxJobs or defaultMaxDispersionJobs()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.maxJobs)
+        self.callbackPool = concurrent.futures.ThreadPoolExecutor(max_workers=maxCallbacks)
+        self.lock = threading.Lock()
+        self.futuresByPath = {}
+        self.groups = []
+        # Runs that were not cached, for progress
+        self.runs = []
+        self.cancelEvent = threading.Event()
+
+    def submitGroup(self, key, runs, onComplete=None):
+        """Queue the runs of a group; pathList passed to onComplete is in the order of runs"""
+        group = {'key': key, 'futures': [], 'remaining': len(runs), 'onComplete': onComplete,
+                'result': concurrent.futures.Future()}
+        # Cache lookups read the manifest and the cache folder, so they are done without holding the lock,
+        # ...which runDone needs
+        cached = {}
+        for run in runs:
+            with self.lock:
+                queued = run.path() in self.futuresByPath
+            if not queued and run.path() not in cached:
+                # A miss is counted by findOrRun
+                cached[run.path()] = run.isComplete(countLookup=False, verify=True)
+                if not cached[run.path()]:
+                    # Fetch met files ahead of the runs, in the same order as the runs are queued
+                    run.prefetchWeatherFiles()
+        with self.lock:
+            self.groups.append(group)
+            for run in runs:
+                future = self.futuresByPath.get(run.path())
+                if future is None:
+                    if cached[run.path()]:
+                        run.manifest().recordLookup(True, run.localPath())
+                        # Cached runs do not need a thread
+                        future = concurrent.futures.Future()
+                        future.set_result(run.path())
+                    else:
+                        future = self.pool.submit(run.findOrRun, self.cancelEvent)
+                        future.add_done_callback(lambda future, run=run: run.releasePrefetchedWeatherFiles())
+                        self.runs.append((run, future))
+                    self.futuresByPath[run.path()] = future
+                group['futures'].append(future)
+        if not runs:
+            self.groupDone(group)
+        for future in group['futures']:
+            future.add_done_callback(lambda future, group=group: self.runDone(group))
+        return group['result']
+
+    def runDone(self, group):
+        with self.lock:
+            group['remaining'] -= 1
+            if group['remaining']:
+                return
+        self.groupDone(group)
+
+    def groupDone(self, group):
+        # Save the lookups of the group now, in case this process does not get to shutdown
+        flushAllLookups()
+        for future in group['futures']:
+            if future.cancelled():
+                group['result'].set_exception(concurrent.futures.CancelledError())
+                return
+            if future.exception() is not None:
+                group['result'].set_exception(future.exception())
+                return
+        pathList = [future.result() for future in group['futures']]
+        print('DispersionRunScheduler: all %d runs of %s complete' % (len(pathList), group['key']))
+        if group['onComplete'] is None:
+            group['result'].set_result(pathList)
+        else:
+            self.callbackPool.submit(self.callOnComplete, group, pathList)
+
+    def callOnComplete(self, group, pathList):
+        try:
+            group['result'].set_result(group['onComplete'](pathList))
+        except Exception as e:
+            group['result'].set_exception(e)
+
+    def progress(self):
+        """Hours simulated so far and in all, over the runs that were not cached"""
+        with self.lock:
+            runs = list(self.runs)
+        simulatedHrs = sum(run.runTimeHrs if future.done() else run.simulatedHrs for run, future in runs)
+        return simulatedHrs, sum(run.runTimeHrs for run, _ in runs)
+
+    def cancel(self):
+        """Drop the queued runs and kill the running hycs_std processes; shutdown then raises"""
+        self.cancelEvent.set()
+        with self.lock:
+            futures = list(self.futuresByPath.values())
+        for future in futures:
+            future.cancel()
+
+    def shutdown(self):
+        """
+        Wait for all groups, continuing past failures
+        Output:
+            the results of the groups in submission order (pathList, or the return value of onComplete)
+        """
+        # Joining the run threads also waits for their done callbacks, which queue the last onComplete calls
+        self.pool.shutdown()
+        self.callbackPool.shutdown()
+        flushAllLookups()
+        results = []
+        exceptionCount = 0
+        for group in self.groups:
+            try:
+                results.append(group['result'].result())
+            except Exception:
+                exceptionCount += 1
+                sys.stderr.write('Exception caught in DispersionRunScheduler group %s\n' % group['key'] +
+                    'Exception follows:\n' + traceback.format_exc())
+        if exceptionCount:
+            raise Exception('DispersionRunScheduler failed: %d of %d groups raised exception' % (exceptionCount, len(self.groups)))
+        print('DispersionRunScheduler succeeded: all %d groups completed' % len(self.groups))
+        return results
@@ -0,0 +1,593 @@
+"""
+SQLite manifest of the completed HYSPLIT runs in a dispersion cache
+The manifest lives in the cache folder (dispersionCachePath/manifest.sqlite3) and has one row per run folder,
+...recorded when CachedDispersionRun renames its temp folder to the final path
+It answers "what is cached" without walking or stat-ing the deep cache folders on the network filesystem
+SQLite assumes that only one host uses a database, so processes on several hosts that share the cache folder
+...take a FileLock (manifest.sqlite3.lock) around every use of the manifest, like the locks of the runs
+It also drives the garbage collection of the cache (see collectGarbage), which only deletes recorded runs,
+...so run "rebuild" once to adopt runs that were completed before the manifest existed
+
+Usage:
+    python dispersion_cache_lib.py rebuild [dispersionCachePath]
+    python dispersion_cache_lib.py summary [dispersionCachePath] [source substring] [year]
+    python dispersion_cache_lib.py telemetry [dispersionCachePath] [source substring] [year]
+    python dispersion_cache_lib.py gc [dispersionCachePath] [target size in GB] [max age in days] [pinned dates...]
+    python dispersion_cache_lib.py gc_dry_run [dispersionCachePath] [target size in GB] [max age in days] [pinned dates...]
+Use "none" for no target size or no max age; pinned dates are YYYY-MM-DD (e.g., the dates of the gallery)
+"""
+
+
+import os, re, sys, json, time, shutil, sqlite3, threading, datetime, dateutil.parser
+from filelock import FileLock, Timeout
+
+
+MANIFEST_FILENAME = 'manifest.sqlite3'
+# Resources used by a run, written in its folder by CachedDispersionRun.makeTelemetryJson
+TELEMETRY_FILENAME = 'telemetry.json'
+DEFAULT_DISPERSION_CACHE_PATH = '/projects/earthtime/air-src/linRegModel/dispersionStiltCache'
+DEFAULT_FORECAST_DISPERSION_CACHE_PATH = '/projects/earthtime/air-src/linRegModel/dispersionStiltForecastCache'
+
+# Run folder names, see CachedDispersionRun.localPath
+RUN_FOLDER_PATTERN = re.compile(
+    r'^(?P<start>\d{8}_\d{6}[-+]\d{4})_(?P<emit>[\d.]+)h_(?P<run>[\d.]+)h_(?P<initd>\d+)'
+    r'(?:_[PD](?P<pardump>\d+))?(?:_Q(?P<qcycle>[\d.]+))?$')
+
+# Temp folders of runs, see CachedDispersionRun.tmpPath
+TMP_FOLDER_PATTERN = re.compile(r'^(?P<run>.+)_(?P<pid>\d+)_(?P<tid>\d+)\.tmp$')
+
+# Temp folders younger than this are never reaped, even when their lock is free
+REAP_MIN_AGE_SECS = 6 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    localPath TEXT PRIMARY KEY,
+    sourcePath TEXT NOT NULL,
+    runStartLocal TEXT NOT NULL,
+    runStartEpoch REAL NOT NULL,
+    emitTimeHrs REAL NOT NULL,
+    runTimeHrs REAL NOT NULL,
+    initd INTEGER NOT NULL,
+    pardumpMinutes INTEGER NOT NULL,
+    qcycleHrs REAL,
+    sizeBytes INTEGER NOT NULL,
+    completedAt REAL NOT NULL,
+    lastUsedAt REAL
+);
+CREATE INDEX IF NOT EXISTS runsBySourceAndStart ON runs (sourcePath, runStartEpoch);
+CREATE TABLE IF NOT EXISTS lookups (
+    day TEXT PRIMARY KEY,
+    hits INTEGER NOT NULL,
+    misses INTEGER NOT NULL
+);
+"""
+
+
+def parseLocalPath(localPath):
+    """
+    Parse the cache path of a run relative to dispersionCachePath (see CachedDispersionRun.localPath)
+    Output:
+        a dict with the columns of the runs table (without sizeBytes and completedAt), or None if it is not a run folder
+    """
+    sourcePath, folder = os.path.split(localPath)
+    m = RUN_FOLDER_PATTERN.match(folder)
+    if not sourcePath or not m:
+        return None
+    runStartLocal = dateutil.parser.parse(m.group('start').replace('_', ' '))
+    return {
+        'localPath': localPath,
+        'sourcePath': sourcePath,
+        'runStartLocal': runStartLocal.isoformat(),
+        'runStartEpoch': runStartLocal.timestamp(),
+        'emitTimeHrs': float(m.group('emit')),
+        'runTimeHrs': float(m.group('run')),
+        'initd': int(m.group('initd')),
+        'pardumpMinutes': int(m.group('pardump') or 1),
+        'qcycleHrs': float(m.group('qcycle')) if m.group('qcycle') else None,
+    }
+
+
+def folderSize(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class DispersionCacheManifest:
+    """
+    The manifest of one dispersion cache folder
+    Usage:
+        manifest = getDispersionCacheManifest(dispersionCachePath)
+        manifest.isRecorded(run.localPath())
+        manifest.recordRun(run.localPath())
+        manifest.runs(sourcePath='40.538261,-79.790391_0-50', start=..., end=...)
+    """
+    def __init__(self, dispersionCachePath):
+        self.dispersionCachePath = dispersionCachePath
+        self.path = os.path.join(dispersionCachePath, MANIFEST_FILENAME)
+        self.lock = threading.Lock()
+        self.schemaCreated = False
+        self.recorded = None
+        self.hits = 0
+        self.misses = 0
+        self.used = set()
+
+    def fileLock(self):
+        """
+        A lock that serializes the use of the manifest by the processes of all hosts (e.g., work_hysplit workers),
+        ...since SQLite's own locking is not reliable on NFS
+        """
+        os.makedirs(self.dispersionCachePath, exist_ok=True)
+        return FileLock(self.path + '.lock')
+
+    def connect(self):
+        """A new connection (sqlite3 connections should not be shared between threads)"""
+        os.makedirs(self.dispersionCachePath, exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=600)
+        db.row_factory = sqlite3.Row
+        if not self.schemaCreated:
+            db.executescript(SCHEMA)
+            self.schemaCreated = True
+        return db
+
+    def recordRun(self, localPath, completedAt=None):
+        """Record a completed run folder, in one transaction; a run that is already recorded keeps its times"""
+        row = parseLocalPath(localPath)
+        if row is None:
+            print('Not recording %s in the dispersion cache manifest: unknown folder name' % localPath)
+            return
+        row['sizeBytes'] = folderSize(os.path.join(self.dispersionCachePath, localPath))
+        row['completedAt'] = completedAt or time.time()
+        with self.fileLock():
+            db = self.connect()
+            try:
+                with db:
+                    db.execute('INSERT INTO runs (%s) VALUES (%s) '
+                            'ON CONFLICT(localPath) DO UPDATE SET sizeBytes = excluded.sizeBytes' % (
+                        ','.join(row.keys()), ','.join(':' + k for k in row.keys())), row)
+            finally:
+                db.close()
+        with self.lock:
+            if self.recorded is not None:
+                self.recorded.add(localPath)
+
+    def updateRunSize(self, localPath):
+        """Measure a recorded run folder again, after files were added to it (e.g., the sidecar of its PARTICLE.DAT)"""
+        sizeBytes = folderSize(os.path.join(self.dispersionCachePath, localPath))
+        with self.fileLock():
+            db = self.connect()
+            try:
+                with db:
+                    db.execute('UPDATE runs SET sizeBytes = ? WHERE localPath = ?', (sizeBytes, localPath))
+            finally:
+                db.close()
+
+    def forgetRun(self, localPath):
+        """Remove a run folder that was deleted from the cache"""
+        with self.fileLock():
+            db = self.connect()
+            try:
+                with db:
+                    db.execute('DELETE FROM runs WHERE localPath = ?', (localPath,))
+            finally:
+                db.close()
+        with self.lock:
+            if self.recorded is not None:
+                self.recorded.discard(localPath)
+
+    def isRecorded(self, localPath, refresh=False):
+        """
+        True if the run is in the manifest; all recorded paths are read once, so bulk lookups stay in memory
+        refresh -- on a miss, check the manifest again, since other processes may have recorded the run since
+        """
+        with self.lock:
+            if self.recorded is None:
+                with self.fileLock():
+                    db = self.connect()
+                    try:
+                        self.recorded = set(r[0] for r in db.execute('SELECT localPath FROM runs'))
+                    finally:
+                        db.close()
+            if localPath in self.recorded or not refresh:
+                return localPath in self.recorded
+        with self.fileLock():
+            db = self.connect()
+            try:
+                recorded = db.execute('SELECT 1 FROM runs WHERE localPath = ?', (localPath,)).fetchone() is not None
+            finally:
+                db.close()
+        if recorded:
+            with self.lock:
+                self.recorded.add(localPath)
+        return recorded
+
+    def recordLookup(self, hit, localPath=None):
+        """
+        Count a cache lookup for the hit rate, and mark the run of a hit as used for the garbage collection
+        Both are saved by flushLookups
+        """
+        with self.lock:
+            if hit:
+                self.hits += 1
+                if localPath is not None:
+                    self.used.add(localPath)
+            else:
+                self.misses += 1
+
+    def flushLookups(self):
+        """Add the lookups counted since the last flush to today's row of the lookups table"""
+        with self.lock:
+            hits, misses, used = self.hits, self.misses, self.used
+            self.hits = self.misses = 0
+            self.used = set()
+        if not hits and not misses:
+            return
+        now = time.time()
+        with self.fileLock():
+            db = self.connect()
+            try:
+                with db:
+                    db.execute('INSERT INTO lookups (day, hits, misses) VALUES (?, ?, ?) '
+                            'ON CONFLICT(day) DO UPDATE SET hits = hits + excluded.hits, misses = misses + excluded.misses',
+                            (datetime.date.today().isoformat(), hits, misses))
+                    db.executemany('UPDATE runs SET lastUsedAt = ? WHERE localPath = ?',
+                            [(now, localPath) for localPath in used])
+            finally:
+                db.close()
+
+    def runs(self, sourcePath=None, start=None, end=None):
+        """
+        The recorded runs, optionally of one source (cachePath) and with runStartLocal in [start, end)
+        Output:
+            a list of sqlite3.Row objects with the columns of the runs table
+        """
+        query, args = 'SELECT * FROM runs WHERE 1', []
+        if sourcePath is not None:
+            query += ' AND sourcePath = ?'
+            args.append(sourcePath)
+        if start is not None:
+            query += ' AND runStartEpoch >= ?'
+            args.append(start.timestamp())
+        if end is not None:
+            query += ' AND runStartEpoch < ?'
+            args.append(end.timestamp())
+        with self.fileLock():
+            db = self.connect()
+            try:
+                return db.execute(query + ' ORDER BY sourcePath, runStartEpoch', args).fetchall()
+            finally:
+                db.close()
+
+    def hitRates(self):
+        """Hits, misses, and hit rate of the cache lookups of each day"""
+        with self.fileLock():
+            db = self.connect()
+            try:
+                rows = db.execute('SELECT day, hits, misses FROM lookups ORDER BY day').fetchall()
+            finally:
+                db.close()
+        return [(r['day'], r['hits'], r['misses'], r['hits'] / max(1, r['hits'] + r['misses'])) for r in rows]
+
+    def rebuild(self):
+        """
+        Replace the runs table with a scan of the cache folder (temp folders of unfinished runs are skipped)
+        The last use times of the runs that were already recorded are kept
+        """
+        with self.fileLock():
+            db = self.connect()
+            try:
+                lastUsed = dict(db.execute('SELECT localPath, lastUsedAt FROM runs').fetchall())
+            finally:
+                db.close()
+        rows = []
+        for source in sorted(os.listdir(self.dispersionCachePath)):
+            sourceDir = os.path.join(self.dispersionCachePath, source)
+            if not os.path.isdir(sourceDir):
+                continue
+            for folder in sorted(os.listdir(sourceDir)):
+                fullPath = os.path.join(sourceDir, folder)
+                row = parseLocalPath(os.path.join(source, folder))
+                # A run is complete when its cdump exists, see CachedDispersionRun.assertComplete
+                if row is None or not os.path.exists(os.path.join(fullPath, 'cdump')):
+                    continue
+                row['sizeBytes'] = folderSize(fullPath)
+                row['completedAt'] = os.path.getmtime(fullPath)
+                row['lastUsedAt'] = lastUsed.get(row['localPath'])
+                rows.append(row)
+        with self.fileLock():
+            db = self.connect()
+            try:
+                with db:
+                    db.execute('DELETE FROM runs')
+                    if rows:
+                        db.executemany('INSERT INTO runs (%s) VALUES (%s)' % (
+                            ','.join(rows[0].keys()), ','.join(':' + k for k in rows[0].keys())), rows)
+            finally:
+                db.close()
+        with self.lock:
+            self.recorded = None
+        print('Rebuilt %s with %d runs' % (self.path, len(rows)))
+        return len(rows)
+
+
+    def deleteRun(self, localPath, dryRun=False):
+        """
+        Delete a run folder and forget it, unless its lock is held (the run is being computed or deleted elsewhere)
+        The folder is first renamed to a temp folder, so that it disappears at once for other processes
+        Output:
+            True if the run was deleted (or would be, when dryRun is True)
+        """
+        fullPath = os.path.join(self.dispersionCachePath, localPath)
+        try:
+            with FileLock(fullPath + '.lock', timeout=0):
+                if not os.path.exists(fullPath):
+                    self.forgetRun(localPath)
+                    return False
+                print('%s %s' % ('Would delete' if dryRun else 'Deleting', fullPath))
+                if dryRun:
+                    return True
+                tmpPath = '%s_%d_%d.tmp' % (fullPath, os.getpid(), threading.get_ident())
+                # Forget the run only once it is gone, so that a failed rename leaves it recorded
+                os.rename(fullPath, tmpPath)
+                self.forgetRun(localPath)
+                shutil.rmtree(tmpPath)
+            # The lock file is kept, since other processes may have opened it and be waiting on it
+            return True
+        except Timeout:
+            print('Not deleting %s: its lock is held' % fullPath)
+            return False
+
+    def reapStale(self, minAgeSecs=REAP_MIN_AGE_SECS, dryRun=False, scratchRoot=None):
+        """
+        Delete the temp folders of crashed runs, and their scratch folders in scratchRoot if it is not None
+        ...(scratch folders are on a local disk, so this only reaps the ones of this host)
+        Only folders older than minAgeSecs whose run lock is free are deleted,
+        ...since a live run holds its lock while it writes its temp folder (see CachedDispersionRun.run)
+        Lock files are never deleted: a process that opened a lock file before it was unlinked and a process
+        ...that created a new one would both hold the lock
+        Output:
+            the number of temp folders deleted
+        """
+        reaped = 0
+        cutoff = time.time() - minAgeSecs
+        sourceDirs = []
+        for root in [self.dispersionCachePath, scratchRoot]:
+            if root and os.path.isdir(root):
+                sourceDirs += [(os.path.join(root, source), source) for source in sorted(os.listdir(root))]
+        for sourceDir, source in sourceDirs:
+            if not os.path.isdir(sourceDir):
+                continue
+            for name in sorted(os.listdir(sourceDir)):
+                m = TMP_FOLDER_PATTERN.match(name)
+                if not m:
+                    continue
+                fullPath = os.path.join(sourceDir, name)
+                # Runs are locked in the cache folder, including the ones that run in scratchRoot
+                lockPath = os.path.join(self.dispersionCachePath, source, m.group('run')) + '.lock'
+                try:
+                    if os.path.getmtime(fullPath) > cutoff:
+                        continue
+                    if os.path.exists(lockPath):
+                        with FileLock(lockPath, timeout=0):
+                            self.deleteStale(fullPath, dryRun)
+                    else:
+                        # No run of this folder can hold the lock, and acquiring it would create the lock file
+                        self.deleteStale(fullPath, dryRun)
+                    reaped += 1
+                except (Timeout, OSError):
+                    # In use, or deleted by another process
+                    continue
+        return reaped
+
+    def deleteStale(self, fullPath, dryRun):
+        print('%s stale temp folder %s' % ('Would delete' if dryRun else 'Deleting', fullPath))
+        if not dryRun:
+            shutil.rmtree(fullPath)
+
+    def collectGarbage(self, targetBytes=None, maxAgeDays=None, pinned=(), dryRun=False,
+                       reapMinAgeSecs=REAP_MIN_AGE_SECS, scratchRoot=None):
+        """
+        Garbage collection of the cache folder
+        Input:
+            targetBytes: delete the least recently used runs until the recorded runs fit in this size (None means no limit)
+            maxAgeDays: delete the runs that were not used for this many days (None means no limit)
+            pinned: a list of (start, end) datetimes, the runs that start in [start, end) are never deleted
+            dryRun: only print what would be deleted
+            reapMinAgeSecs, scratchRoot: see reapStale
+        Output:
+            the number of runs deleted and the bytes freed
+        """
+        self.flushLookups()
+        self.reapStale(reapMinAgeSecs, dryRun=dryRun, scratchRoot=scratchRoot)
+        pinnedEpochs = [(start.timestamp(), end.timestamp()) for start, end in pinned]
+        with self.fileLock():
+            db = self.connect()
+            try:
+                rows = db.execute('SELECT localPath, runStartEpoch, sizeBytes, COALESCE(lastUsedAt, completedAt) AS usedAt '
+                        'FROM runs ORDER BY usedAt').fetchall()
+            finally:
+                db.close()
+        total = sum(r['sizeBytes'] for r in rows)
+        ageCutoff = None if maxAgeDays is None else time.time() - maxAgeDays * 86400
+        deleted, freed = 0, 0
+        for r in rows:
+            expired = ageCutoff is not None and r['usedAt'] < ageCutoff
+            overTarget = targetBytes is not None and total > targetBytes
+            if not expired and not overTarget:
+                # Rows are sorted by last use, so later runs are neither expired nor needed to reach the target
+                break
+            if any(start <= r['runStartEpoch'] < end for start, end in pinnedEpochs):
+                continue
+            try:
+                if not self.deleteRun(r['localPath'], dryRun=dryRun):
+                    continue
+            except OSError as e:
+                print('Could not delete %s: %s' % (r['localPath'], e))
+                continue
+            deleted += 1
+            freed += r['sizeBytes']
+            total -= r['sizeBytes']
+        print('%s %d runs (%.1f GB), %.1f GB of runs left in %s' % (
+            'Would delete' if dryRun else 'Deleted', deleted, freed / 1e9, total / 1e9, self.dispersionCachePath))
+        return deleted, freed
+
+
+_manifests = {}
+_manifestsLock = threading.Lock()
+
+
+def getDispersionCacheManifest(dispersionCachePath):
+    """The DispersionCacheManifest of this process for the folder dispersionCachePath"""
+    path = os.path.abspath(dispersionCachePath)
+    with _manifestsLock:
+        if path not in _manifests:
+            _manifests[path] = DispersionCacheManifest(path)
+        return _manifests[path]
+
+
+def updateRunFolderSize(runFolder):
+    """updateRunSize for the full path of a run folder, if its cache folder has a manifest"""
+    runFolder = os.path.abspath(runFolder)
+    dispersionCachePath = os.path.dirname(os.path.dirname(runFolder))
+    localPath = os.path.relpath(runFolder, dispersionCachePath)
+    if parseLocalPath(localPath) is None or not os.path.exists(os.path.join(dispersionCachePath, MANIFEST_FILENAME)):
+        return
+    getDispersionCacheManifest(dispersionCachePath).updateRunSize(localPath)
+
+
+def flushAllLookups():
+    """Save the lookup counts of every manifest of this process"""
+    with _manifestsLock:
+        manifests = list(_manifests.values())
+    for manifest in manifests:
+        manifest.flushLookups()
+
+
+def printSummary(manifest, sourceSubstring=None, year=None):
+    """Print the number and size of recorded runs per source (and year), and the lookup hit rates"""
+    counts = {}
+    for r in manifest.runs():
+        if sourceSubstring and sourceSubstring not in r['sourcePath']:
+            continue
+        runYear = r['runStartLocal'][:4]
+        if year and runYear != str(year):
+            continue
+        key = (r['sourcePath'], runYear)
+        count, size = counts.get(key, (0, 0))
+        counts[key] = (count + 1, size + r['sizeBytes'])
+    for (sourcePath, runYear), (count, size) in sorted(counts.items()):
+        print('%s %s: %d runs, %.1f GB' % (sourcePath, runYear, count, size / 1e9))
+    for day, hits, misses, rate in manifest.hitRates():
+        print('%s: %d hits, %d misses, hit rate %.1f%%' % (day, hits, misses, 100 * rate))
+
+
+def readTelemetry(manifest, sourceSubstring=None, year=None, maxRuns=None):
+    """
+    The telemetry of the recorded runs (runs completed before telemetry was added have none)
+    maxRuns -- if not None, only read the telemetry of this many most recently completed runs
+    """
+    telemetry = []
+    rows = manifest.runs()
+    if maxRuns is not None:
+        rows = sorted(rows, key=lambda r: r['completedAt'])[-maxRuns:]
+    for r in rows:
+        if sourceSubstring and sourceSubstring not in r['sourcePath']:
+            continue
+        if year and r['runStartLocal'][:4] != str(year):
+            continue
+        try:
+            with open(os.path.join(manifest.dispersionCachePath, r['localPath'], TELEMETRY_FILENAME)) as f:
+                telemetry.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return telemetry
+
+
+def settingsKey(emitTimeHrs, runTimeHrs, initd, pardumpMinutes, qcycleHrs):
+    """The model settings of a run, for grouping telemetry (like the suffix of CachedDispersionRun.localPath)"""
+    return '%gh_%gh_%d_P%d%s' % (emitTimeHrs, runTimeHrs, initd, pardumpMinutes, '_Q%g' % qcycleHrs if qcycleHrs else '')
+
+
+def telemetryEstimates(manifest, maxRuns=1000):
+    """
+    Mean resources of the recently completed runs, for estimating the cost of new runs
+    Output:
+        a dict from settingsKey to (runs, mean CPU seconds, mean output bytes), and
+        ...(runs, CPU seconds, output bytes) per simulated hour over all settings, or None without telemetry
+    """
+    sums = {}
+    allRuns, allCpu, allBytes, allHrs = 0, 0, 0, 0
+    for t in readTelemetry(manifest, maxRuns=maxRuns):
+        key = settingsKey(t['emitTimeHrs'], t['runTimeHrs'], t['initd'], t['pardumpMinutes'], t['qcycleHrs'])
+        cpu = t['userCpuSecs'] + t['sysCpuSecs']
+        runs, cpuSum, bytesSum = sums.get(key, (0, 0, 0))
+        sums[key] = (runs + 1, cpuSum + cpu, bytesSum + t['outputBytes'])
+        allRuns, allCpu, allBytes, allHrs = allRuns + 1, allCpu + cpu, allBytes + t['outputBytes'], allHrs + t['runTimeHrs']
+    estimates = {key: (runs, cpuSum / runs, bytesSum / runs) for key, (runs, cpuSum, bytesSum) in sums.items()}
+    perHour = (allRuns, allCpu / allHrs, allBytes / allHrs) if allHrs else None
+    return estimates, perHour
+
+
+def printTelemetryReport(manifest, sourceSubstring=None, year=None):
+    """
+    Print the resources used by the runs per source, month, and model settings
+    CPU/wall near 1 means that hycs_std is CPU bound (run about one job per CPU),
+    ...and lower values mean waiting on I/O (more jobs than CPUs may help, if the peak RSS fits in memory)
+    """
+    groups = {}
+    for t in readTelemetry(manifest, sourceSubstring, year):
+        settings = settingsKey(t['emitTimeHrs'], t['runTimeHrs'], t['initd'], t['pardumpMinutes'], t['qcycleHrs'])
+        groups.setdefault((t['sourcePath'], t['runStartLocal'][:7], settings), []).append(t)
+    print('source month settings: runs, mean wall s, mean CPU s, CPU/wall, max peak RSS MB, mean output MB, mean met wait s')
+    for (sourcePath, month, settings), ts in sorted(groups.items()):
+        wall = sum(t['wallSecs'] for t in ts)
+        cpu = sum(t['userCpuSecs'] + t['sysCpuSecs'] for t in ts)
+        peakRss = max(t['peakRssBytes'] or 0 for t in ts)
+        print('%s %s %s: %d, %.0f, %.0f, %.2f, %.0f, %.0f, %.1f' % (sourcePath, month, settings, len(ts),
+            wall / len(ts), cpu / len(ts), cpu / max(wall, 1e-9), peakRss / 1e6,
+            sum(t['outputBytes'] for t in ts) / len(ts) / 1e6, sum(t['metWaitSecs'] for t in ts) / len(ts)))
+
+
+def parseOptionalFloat(s):
+    return None if s.lower() == 'none' else float(s)
+
+
+def pinnedDateRanges(dates):
+    """
+    Pinned (start, end) ranges for YYYY-MM-DD dates in local time
+    A day of margin is kept on each side, since the runs shown for a date start a few hours before it
+    ...(see get_time_range_list in automate_plume_viz.py) and last beyond it
+    """
+    ranges = []
+    for d in dates:
+        day = datetime.datetime.strptime(d, '%Y-%m-%d')
+        ranges.append((day - datetime.timedelta(days=1), day + datetime.timedelta(days=2)))
+    return ranges
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in ['rebuild', 'summary', 'telemetry', 'gc', 'gc_dry_run']:
+        print(__doc__)
+        return
+    dispersionCachePath = argv[2] if len(argv) > 2 else DEFAULT_DISPERSION_CACHE_PATH
+    manifest = getDispersionCacheManifest(dispersionCachePath)
+    if argv[1] == 'rebuild':
+        manifest.rebuild()
+    if argv[1] == 'summary':
+        printSummary(manifest, argv[3] if len(argv) > 3 else None, argv[4] if len(argv) > 4 else None)
+    if argv[1] == 'telemetry':
+        printTelemetryReport(manifest, argv[3] if len(argv) > 3 else None, argv[4] if len(argv) > 4 else None)
+    if argv[1] in ['gc', 'gc_dry_run']:
+        targetGb = parseOptionalFloat(argv[3]) if len(argv) > 3 else None
+        maxAgeDays = parseOptionalFloat(argv[4]) if len(argv) > 4 else None
+        manifest.collectGarbage(targetBytes=None if targetGb is None else targetGb * 1e9, maxAgeDays=maxAgeDays,
+                pinned=pinnedDateRanges(argv[5:]), dryRun=argv[1] == 'gc_dry_run')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -4,13 +4,16 @@ The main script for processing the plume visualization videos
 """
 
 
-import sys, os, time
+import sys, os, time, functools, hashlib, traceback, collections
+import concurrent.futures
 import pandas as pd
 from datetime import date
 from datetime import timedelta
-from multiprocessing.dummy import Pool
-from cached_hysplit_run_lib import DispersionSource
-from automate_plume_viz import get_time_range_list, generate_metadata, simulate_worker, is_url_valid, get_frames, get_all_dir_names_in_folder, unzip_and_rename, create_video, generate_plume_viz_json, get_start_end_time_list
+from cached_hysplit_run_lib import DispersionSource, DispersionRunScheduler
+from dispersion_cache_lib import getDispersionCacheManifest, flushAllLookups, telemetryEstimates, settingsKey, DEFAULT_DISPERSION_CACHE_PATH, DEFAULT_FORECAST_DISPERSION_CACHE_PATH
+from met_file_lib import hrrrFileName
+from work_queue_lib import WorkQueue
+from automate_plume_viz import get_time_range_list, generate_metadata, plan_simulation_runs, build_bin, is_bin_done, is_url_valid, get_frames, get_all_dir_names_in_folder, unzip_and_rename, create_video, generate_plume_viz_json, get_start_end_time_list
 
 
 def genetate_earthtime_data(date_list, bin_url, url_partition, img_size, redo, prefix,
@@ -52,10 +55,21 @@ def genetate_earthtime_data(date_list, bin_url, url_partition, img_size, redo, p
     return (start_d, end_d, file_name, df_share_url, df_img_url)
 
 
-def run_hysplit(sources, bin_root, start_d, end_d, file_name, bin_url=None, num_workers=4, use_forecast=False):
+def run_hysplit(sources, bin_root, start_d, end_d, file_name, bin_url=None, num_workers=4, use_forecast=False,
+        memory_budget_gb=None, max_hysplit_jobs=None, emission_cycling=False, multi_source=False,
+        pardump_minutes=1, scratch_root=None, use_pardump=False):
     print("Run Hysplit model...")
     print("Using num workers: %s" % num_workers)
 
+    # Split the memory budget evenly between the bin files that are created at the same time
+    memory_budget_bytes = None
+    if memory_budget_gb is not None:
+        memory_budget_bytes = int(memory_budget_gb * 1024**3 / num_workers)
+        print("Using memory budget: %s GB (%d bytes per worker)" % (memory_budget_gb, memory_budget_bytes))
+
+    # Split the CPUs the same way between the processes that parse the particle files of each bin file
+    parse_workers = max(1, (os.cpu_count() or 1) // num_workers)
+
     # Prepare the list of dates for running the simulation
     start_time_eastern_all = start_d.strftime("%Y-%m-%d %H:%M").values
 
@@ -73,16 +87,203 @@ def run_hysplit(sources, bin_root, start_d, end_d, file_name, bin_url=None, num_
     duration = (end_d[0] - start_d[0]).days * 24  + (end_d[0] - start_d[0]).seconds / 3600
     filter_ratio = 0.8
 
-    # Run the simulation for each date in parallel (be aware of the memory usage)
-    arg_list = []
+    # Queue the hysplit runs of all dates, sources, and hours in one scheduler (max_hysplit_jobs defaults to the CPU count)
+    # Runs are started date by date, and the bin file of a date is created (by up to num_workers threads)
+    # ...as soon as all of its runs are complete (be aware of the memory usage)
     print("Running hysplit simulation with duration: %s hours" % duration)
+    scheduler = DispersionRunScheduler(maxJobs=max_hysplit_jobs, maxCallbacks=num_workers)
+    for i in range(len(bin_file_all)):
+        if is_bin_done(bin_file_all[i], bin_url_all[i]):
+            continue
+        runs = plan_simulation_runs(start_time_eastern_all[i], sources,
+                emit_time_hrs=emit_time_hrs, duration=duration, useForecast=use_forecast, emission_cycling=emission_cycling,
+                multi_source=multi_source, pardump_minutes=pardump_minutes, scratch_root=scratch_root)
+        scheduler.submitGroup(bin_file_all[i], runs, onComplete=functools.partial(build_bin, bin_file_all[i], sources,
+            filter_ratio=filter_ratio, use_pardump=use_pardump, memory_budget_bytes=memory_budget_bytes,
+            multi_source=multi_source, max_workers=parse_workers))
+    try:
+        scheduler.shutdown()
+    except Exception:
+        traceback.print_exc()
+
+
+def plan_hysplit(sources, bin_root, start_d, end_d, file_name, bin_url=None, use_forecast=False,
+        emission_cycling=False, multi_source=False, pardump_minutes=1):
+    """
+    Print what run_hysplit would do without running anything: for each date, the hysplit runs that are cached
+    ...and the ones to run, and whether the bin file exists locally or remotely; then the met files that are missing
+    ...locally and the estimated CPU hours and disk space of the runs, from the telemetry of recent runs
+    The cache is only read from its manifest (run "python dispersion_cache_lib.py rebuild" once for older caches),
+    ...so that planning many dates does not stat the cache folders
+
+    Input:
+        (see the run_hysplit function)
+    """
+    print("Plan Hysplit model runs...")
+    start_time_eastern_all = start_d.strftime("%Y-%m-%d %H:%M").values
+    bin_file_all = bin_root + file_name.values + ".bin"
+    duration = (end_d[0] - start_d[0]).days * 24  + (end_d[0] - start_d[0]).seconds / 3600
+
+    # The bin files are written gzipped, and the remote ones are checked in parallel since each check is a request
+    bin_local_all = [os.path.isfile(f) or os.path.isfile(f + ".gz") for f in bin_file_all]
+    bin_remote_all = [False]*len(bin_file_all)
+    if bin_url is not None:
+        def is_remote(i):
+            url = bin_url + file_name.values[i] + ".bin"
+            return not bin_local_all[i] and (is_url_valid(url) or is_url_valid(url + ".gz"))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as pool:
+            bin_remote_all = list(pool.map(is_remote, range(len(bin_file_all))))
+
+    runs_to_do = collections.OrderedDict()
+    num_cached = 0
+    manifest = None
     for i in range(len(bin_file_all)):
-        arg_list.append((start_time_eastern_all[i], bin_file_all[i], sources,
-            emit_time_hrs, duration, filter_ratio, bin_url_all[i], use_forecast))
-    pool = Pool(num_workers)
-    pool.starmap(simulate_worker, arg_list)
-    pool.close()
-    pool.join()
+        bin_state = "local" if bin_local_all[i] else "remote" if bin_remote_all[i] else "missing"
+        if bin_state != "missing":
+            print("%s: bin file exists (%s)" % (start_time_eastern_all[i], bin_state))
+            continue
+        runs = plan_simulation_runs(start_time_eastern_all[i], sources, duration=duration, useForecast=use_forecast,
+                emission_cycling=emission_cycling, multi_source=multi_source, pardump_minutes=pardump_minutes)
+        manifest = runs[0].manifest()
+        missing = [run for run in runs if not manifest.isRecorded(run.localPath())]
+        num_cached += len(runs) - len(missing)
+        for run in missing:
+            runs_to_do[run.path()] = run
+        print("%s: bin file missing, %d runs cached, %d runs to do" % (start_time_eastern_all[i], len(runs) - len(missing), len(missing)))
+    print("Total: %d runs cached, %d runs to do" % (num_cached, len(runs_to_do)))
+    if not runs_to_do:
+        return
+
+    # Met files that are neither unzipped nor gzipped locally (forecast files are not downloaded)
+    met_files = set()
+    for run in runs_to_do.values():
+        if not run.useForecast:
+            met_files.update(os.path.join(run.hrrrDirPath, hrrrFileName(dt)) for dt in run.computeTimes())
+    local_names = {}
+    for hrrr_dir in set(os.path.dirname(f) for f in met_files):
+        local_names[hrrr_dir] = set(os.listdir(hrrr_dir)) if os.path.isdir(hrrr_dir) else set()
+    missing_met = sorted(f for f in met_files
+            if not {os.path.basename(f), os.path.basename(f) + ".gz"} & local_names[os.path.dirname(f)])
+    print("Met files: %d needed, %d missing locally%s" % (len(met_files), len(missing_met),
+        (" (first: %s)" % missing_met[0]) if missing_met else ""))
+
+    # Estimate the cost from the runs with the same settings, or else from all runs per simulated hour
+    estimates, per_hour = telemetryEstimates(manifest)
+    cpu_secs, output_bytes, num_estimated = 0, 0, 0
+    for run in runs_to_do.values():
+        key = settingsKey(run.emitTimeHrs, run.runTimeHrs, run.initdModelType.value,
+                60 if run.hourlyPardump else run.pardumpMinutes, run.qcycleHrs)
+        if key in estimates:
+            cpu_secs += estimates[key][1]
+            output_bytes += estimates[key][2]
+        elif per_hour is not None:
+            cpu_secs += per_hour[1] * run.runTimeHrs
+            output_bytes += per_hour[2] * run.runTimeHrs
+        else:
+            continue
+        num_estimated += 1
+    if num_estimated == 0:
+        print("No telemetry of completed runs, cannot estimate CPU hours and disk space")
+        return
+    print("Estimated for %d of %d runs to do: %.1f CPU hours, %.1f GB in the dispersion cache" % (
+        num_estimated, len(runs_to_do), cpu_secs / 3600, output_bytes / 1e9))
+
+
+def enqueue_hysplit(sources, bin_root, start_d, end_d, file_name, queue_dir, bin_url=None, use_forecast=False,
+        emission_cycling=False, multi_source=False, pardump_minutes=1, use_pardump=False):
+    """
+    Add the hysplit runs and bin files of all dates to the work queue in queue_dir (on the shared filesystem)
+    ...then start "python main.py work_hysplit" in one or more processes on each host to run them
+    The runs that are already cached and the bin files that already exist are skipped
+
+    Input:
+        (see the run_hysplit function)
+    """
+    print("Enqueue Hysplit jobs in %s..." % queue_dir)
+    queue = WorkQueue(queue_dir)
+    start_time_eastern_all = start_d.strftime("%Y-%m-%d %H:%M").values
+    duration = (end_d[0] - start_d[0]).days * 24  + (end_d[0] - start_d[0]).seconds / 3600
+    for i, name in enumerate(file_name.values):
+        bin_file = bin_root + name + ".bin"
+        if is_bin_done(bin_file, None if bin_url is None else bin_url + name + ".bin"):
+            continue
+        args = {"date": start_time_eastern_all[i], "duration": duration, "use_forecast": use_forecast,
+                "emission_cycling": emission_cycling, "multi_source": multi_source, "pardump_minutes": pardump_minutes,
+                "use_pardump": use_pardump}
+        run_ids = []
+        for run in plan_simulation_runs(args["date"], sources, duration=duration, useForecast=use_forecast,
+                emission_cycling=emission_cycling, multi_source=multi_source, pardump_minutes=pardump_minutes):
+            if run.isComplete(countLookup=False):
+                continue
+            # Job ids sort by date, and the bin job of a date after its runs
+            run_id = "%s_1_run_%s" % (name, hashlib.sha1(run.localPath().encode()).hexdigest()[:16])
+            queue.enqueue(run_id, "hysplit", dict(args, local_path=run.localPath()))
+            run_ids.append(run_id)
+        queue.enqueue("%s_2_bin" % name, "bin", dict(args, bin_file=bin_file), deps=run_ids)
+    print(queue.counts())
+
+
+def work_hysplit(sources, queue_dir, memory_budget_gb=None, scratch_root=None):
+    """
+    Run the jobs of the work queue in queue_dir until it is empty (see enqueue_hysplit)
+    The sources must be the same as when the jobs were queued
+
+    Input:
+        memory_budget_gb: the memory (in GB) that creating one bin file may use (None means no limit)
+        scratch_root: see the run_hysplit function
+    """
+    print("Work on Hysplit jobs in %s..." % queue_dir)
+    memory_budget_bytes = None if memory_budget_gb is None else int(memory_budget_gb * 1024**3)
+    filter_ratio = 0.8
+
+    def plan(args):
+        return plan_simulation_runs(args["date"], sources, duration=args["duration"], useForecast=args["use_forecast"],
+                emission_cycling=args["emission_cycling"], multi_source=args["multi_source"],
+                pardump_minutes=args["pardump_minutes"], scratch_root=scratch_root)
+
+    def run_job(args, cancel_event):
+        runs = [run for run in plan(args) if run.localPath() == args["local_path"]]
+        assert(len(runs) == 1), "the sources differ from the ones of the queued job %s" % args["local_path"]
+        try:
+            runs[0].findOrRun(cancel_event)
+        finally:
+            # Save the lookup, so that the garbage collection sees the run as used
+            flushAllLookups()
+
+    def bin_job(args, cancel_event):
+        if is_bin_done(args["bin_file"], None):
+            return
+        try:
+            path_list = [run.findOrRun(cancel_event) for run in plan(args)]
+        finally:
+            flushAllLookups()
+        build_bin(args["bin_file"], sources, path_list, filter_ratio=filter_ratio, use_pardump=args.get("use_pardump", False),
+                memory_budget_bytes=memory_budget_bytes, multi_source=args["multi_source"])
+
+    WorkQueue(queue_dir).work({"hysplit": run_job, "bin": bin_job})
+
+
+def gc_dispersion_cache(date_list, target_gb=None, max_age_days=None, use_forecast=False, dry_run=False,
+        scratch_root=None):
+    """
+    Delete least recently used hysplit runs from the dispersion cache, keeping the runs of the dates in date_list
+
+    Input:
+        date_list: the (start_d, end_d) time ranges of the gallery, see get_time_range_list
+        target_gb: delete runs until the cache fits in this size in GB (None means no limit)
+        max_age_days: delete the runs that were not used for this many days (None means no limit)
+        use_forecast: collect the cache of the forecast runs instead
+        dry_run: only print what would be deleted
+        scratch_root: also delete the scratch folders that crashed runs left in this folder on this host
+        ...(see the run_hysplit function)
+    """
+    print("Collect garbage in the dispersion cache...")
+    cache_path = DEFAULT_FORECAST_DISPERSION_CACHE_PATH if use_forecast else DEFAULT_DISPERSION_CACHE_PATH
+    start_d, end_d = date_list
+    pinned = [(s.to_pydatetime(), e.to_pydatetime()) for s, e in zip(start_d, end_d)]
+    getDispersionCacheManifest(cache_path).collectGarbage(
+            targetBytes=None if target_gb is None else target_gb * 1e9, maxAgeDays=max_age_days,
+            pinned=pinned, dryRun=dry_run, scratchRoot=scratch_root)
 
 
 def download_video_frames(bin_url, df_share_url, df_img_url, prefix="plume_"):
@@ -198,6 +399,39 @@ def main(argv):
     
     num_workers = 4
 
+    # Optionally run one hysplit simulation per source and date that cycles the hourly emission,
+    # ...instead of one simulation per source and hour (fewer processes and less reading of met files)
+    emission_cycling = False
+
+    # Optionally release all sources in the same hysplit simulations, which then read the met files only once
+    # ...the particles are told apart by where they are first dumped, so Irvin and Clairton need pardump_minutes <= 5
+    multi_source = False
+
+    # Minutes between particle dumps of the hysplit simulations (changing it runs new simulations), which divides 60
+    # ...the bin files keep about one position every 10 minutes, so 10 writes and parses the least data,
+    # ...but it is also the hysplit integration time step, so 10 gives coarser trajectories near the sources than 1
+    pardump_minutes = 1
+
+    # Optionally create the bin files from the binary PARDUMP files instead of the text PARTICLE.DAT files
+    use_pardump = False
+
+    # Optionally run the hysplit simulations in a folder on a local disk (e.g., "/dev/shm/hysplit" or a local SSD),
+    # ...and copy the results to the dispersion cache when they complete, instead of writing the particle dumps
+    # ...over the network filesystem (None means running in the cache folder)
+    scratch_root = None
+
+    # Folder of the work queue for running the hysplit simulations on several hosts (enqueue_hysplit and work_hysplit),
+    # ...which must be on a filesystem that all the hosts share
+    work_queue_dir = "data/work_queue/"
+
+    # Optionally limit the memory (in GB) used for creating the bin files, shared by all workers (None means no limit)
+    memory_budget_gb = None
+
+    # Size (in GB) and age (in days since last use) limits of the dispersion cache for the gc_dispersion_cache step
+    # ...(None means no limit), the runs of the dates in date_list are always kept
+    dispersion_cache_target_gb = None
+    dispersion_cache_max_age_days = None
+
     # IMPORTANT: below is the setting for the main project, you should not use these parameters
     # TODO: add a config file for the parameters
     bin_root = "/projects/aircocalc-www.createlab.org/pardumps/plumeviz/bin/" # Yen-Chia's example (DO NOT USE)
@@ -251,11 +485,16 @@ def main(argv):
     # Run the following line first to generate EarthTime layers
     # IMPORTANT: you need to copy and paste the generated layers to the EarthTime layers CSV file
     # ...check the README file about how to do this
-    if argv[1] in ["genetate_earthtime_data", "run_hysplit", "download_video_frames"]:
+    if argv[1] in ["genetate_earthtime_data", "plan_hysplit", "run_hysplit", "enqueue_hysplit", "download_video_frames"]:
         start_d, end_d, file_name, df_share_url, df_img_url = genetate_earthtime_data(date_list, 
                 bin_url, url_partition, img_size, redo, prefix, add_smell, lat, lng, zoom,
                 credits, category, name_prefix, video_start_delay_hrs)
 
+    # Optionally, print the work that run_hysplit would do and its estimated cost, without running anything
+    if argv[1] == "plan_hysplit":
+        plan_hysplit(sources, bin_root, start_d, end_d, file_name, bin_url=bin_url, use_forecast=use_forecast,
+                emission_cycling=emission_cycling, multi_source=multi_source, pardump_minutes=pardump_minutes)
+
     # Then run the following to create hysplit simulation files
     # IMPORTANT: after creating the bin files, you need to move them to the correct folder for public access
     # ... check the README file about how to copy and move the bin files
@@ -263,7 +502,25 @@ def main(argv):
     # ...make sure you set the input argument "bin_url" of the run_hysplit function to None
     # ...otherwise the code will not run because the particle files aleady exist in the remote URLs
     if argv[1] == "run_hysplit":
-        run_hysplit(sources, bin_root, start_d, end_d, file_name, bin_url=bin_url, use_forecast=use_forecast, num_workers=num_workers)
+        run_hysplit(sources, bin_root, start_d, end_d, file_name, bin_url=bin_url, use_forecast=use_forecast, num_workers=num_workers,
+                memory_budget_gb=memory_budget_gb, emission_cycling=emission_cycling, multi_source=multi_source,
+                pardump_minutes=pardump_minutes, scratch_root=scratch_root, use_pardump=use_pardump)
+
+    # Alternatively, to run the hysplit simulations on several hosts, queue them once with enqueue_hysplit,
+    # ...then start work_hysplit in one or more processes on each host (e.g., "sh bg.sh python main.py work_hysplit 1",
+    # ..."sh bg.sh python main.py work_hysplit 2", since bg.sh names its screen sessions after the arguments)
+    # ...(use "python work_queue_lib.py status" to see the progress, and "retry_failed" to queue failed jobs again)
+    if argv[1] == "enqueue_hysplit":
+        enqueue_hysplit(sources, bin_root, start_d, end_d, file_name, work_queue_dir, bin_url=bin_url,
+                use_forecast=use_forecast, emission_cycling=emission_cycling, multi_source=multi_source,
+                pardump_minutes=pardump_minutes, use_pardump=use_pardump)
+    if argv[1] == "work_hysplit":
+        work_hysplit(sources, work_queue_dir, memory_budget_gb=memory_budget_gb, scratch_root=scratch_root)
+
+    # Optionally, delete old hysplit runs that the dates in date_list do not use (add "dry_run" to only print them)
+    if argv[1] == "gc_dispersion_cache":
+        gc_dispersion_cache(date_list, target_gb=dispersion_cache_target_gb, max_age_days=dispersion_cache_max_age_days,
+                use_forecast=use_forecast, dry_run=len(argv) > 2 and argv[2] == "dry_run", scratch_root=scratch_root)
 
     # Next, run the following to download videos
     # IMPORTANT: if you forgot to copy and paste the EarthTime layers, this step will fail
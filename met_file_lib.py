@@ -0,0 +1,334 @@
+"""
+Fetch the HRRR meteorology files that the HYSPLIT runs read, once per file
+Threads of the same process wait on a per-file lock, and other processes wait on a per-file FileLock
+Unzipped copies of .gz files are kept while runs use them, and deleted least recently used first
+...when they exceed the disk budget
+"""
+
+
+import os, sys, datetime, dateutil, glob, gzip, shutil, socket, threading, time, traceback, collections
+import concurrent.futures
+from filelock import FileLock, Timeout
+from utils import download_file, CircuitBreaker
+
+
+# Date when NOAA archive format changed
+HRRR_REFORMAT_TIME = datetime.datetime(2019,7,22,0,0,0,0,dateutil.tz.tzutc())
+
+# Where missing HRRR files are downloaded from (the ARL FTP server is the fallback of the Google Cloud mirror)
+HRRR_GCS_URL = 'https://storage.googleapis.com/high-resolution-rapid-refresh/'
+HRRR_ARL_URL = 'ftp://arlftp.arlhq.noaa.gov/pub/archives/'
+
+# Default disk budget for the unzipped HRRR files that also have a .gz copy (files without one are never deleted)
+METFILE_DISK_BUDGET_BYTES = 50 * 1024**3
+
+# Reference markers are touched this often while they are held, and markers of other hosts that were not touched
+# ...for METFILE_REF_TIMEOUT_SECS belong to a crashed process (markers of this host are checked by pid instead)
+METFILE_REF_HEARTBEAT_SECS = 300
+METFILE_REF_TIMEOUT_SECS = 3600
+
+# Default number of files that prefetch keeps ready ahead of the runs (a 24-hour run reads about 5 files)
+METFILE_PREFETCH_AHEAD_FILES = 10
+
+
+def hrrrFileName(dt):
+    """Name of the HRRR file that starts at the 6-hour UTC time dt"""
+    return dt.strftime('hysplit.%Y%m%d.%Hz.hrrra')
+
+
+class MetFileManager:
+    """
+    Single-flight fetching of the HRRR files in one directory
+    Each missing file is unzipped (from its .gz) or downloaded once,
+    ...and concurrent requests for the same file wait for the first one instead of fetching it again
+    Runs reference the files they read with acquire and release, and unzipped files that are not referenced
+    ...(by any process, see refMarkerPath) are deleted least recently used first to stay within diskBudgetBytes
+    Prefetched files are referenced until a run acquires them (or releasePrefetched), so they are not evicted
+    ...before they are used, and at most prefetchAheadFiles of them are fetched ahead of the runs
+    Usage:
+        manager = getMetFileManager('/projects/earthtime/air-data/hrrr')
+        manager.prefetch(times) # returns immediately, fetches in background threads
+        paths = manager.acquire(times) # returns when the files are available
+        ...
+        manager.release(paths)
+        manager.releasePrefetched(times) # when the run is done, in case it did not acquire them
+    """
+    def __init__(self, hrrrDirPath, prefetchThreads=2, diskBudgetBytes=METFILE_DISK_BUDGET_BYTES,
+                 gcsUrl=HRRR_GCS_URL, arlUrl=HRRR_ARL_URL, prefetchAheadFiles=METFILE_PREFETCH_AHEAD_FILES):
+        self.hrrrDir = os.path.abspath(hrrrDirPath)
+        # Base URLs can point to a local stand-in server for testing
+        self.gcsUrl = gcsUrl
+        self.arlUrl = arlUrl
+        self.gcsBreaker = CircuitBreaker('GCS HRRR archive')
+        self.arlBreaker = CircuitBreaker('ARL FTP HRRR archive')
+        self.diskBudgetBytes = diskBudgetBytes
+        self.lock = threading.Lock()
+        self.pathLocks = {}
+        self.refs = collections.Counter()
+        # Set when this process adds a file, which is the only time evict has to scan the directory
+        self.needsEvict = True
+        self.heartbeatThread = None
+        # Paths queued, being fetched, or held for a run, so that each is prefetched once
+        self.prefetched = set()
+        self.prefetchQueue = collections.deque()
+        # Prefetched paths that hold a reference until a run acquires them
+        self.prefetchHeld = set()
+        self.prefetchRunning = 0
+        self.prefetchThreads = prefetchThreads
+        self.prefetchAheadFiles = prefetchAheadFiles
+        self.prefetchPool = concurrent.futures.ThreadPoolExecutor(max_workers=prefetchThreads)
+
+    def path(self, dt):
+        return os.path.join(self.hrrrDir, hrrrFileName(dt))
+
+    def pathLock(self, fullPath):
+        with self.lock:
+            return self.pathLocks.setdefault(fullPath, threading.Lock())
+
+    def fetch(self, dt, addRef=False):
+        """Make sure the HRRR file for time dt exists uncompressed and return its path"""
+        fullPath = self.path(dt)
+        if os.path.exists(fullPath) and not addRef:
+            return fullPath
+        with self.pathLock(fullPath):
+            os.makedirs(self.hrrrDir, exist_ok=True)
+            with FileLock(fullPath + '.lock'):
+                # Another thread or process may have fetched the file while we waited
+                if not os.path.exists(fullPath):
+                    self.fetchLocked(dt, fullPath)
+                if addRef:
+                    # Under the locks, so that evict cannot delete the file in between
+                    self.addRef(fullPath)
+        return fullPath
+
+    def acquire(self, dts):
+        """Fetch the HRRR files for times dts and keep them unzipped until release"""
+        paths = [self.fetch(dt, addRef=True) for dt in dts]
+        # The run holds its own references now
+        self.releasePrefetched(dts)
+        self.evict()
+        return paths
+
+    def release(self, paths):
+        """Drop the references of acquire, marking the files as recently used"""
+        for fullPath in paths:
+            self.removeRef(fullPath)
+            try:
+                os.utime(fullPath)
+            except OSError:
+                pass
+        self.evict()
+
+    def refMarkerPath(self, fullPath):
+        """File that tells other processes that this process uses fullPath"""
+        return '%s.ref_%s_%d' % (fullPath, socket.gethostname(), os.getpid())
+
+    def addRef(self, fullPath):
+        with self.lock:
+            self.refs[fullPath] += 1
+            if self.refs[fullPath] == 1:
+                open(self.refMarkerPath(fullPath), 'w').close()
+            if self.heartbeatThread is None:
+                self.heartbeatThread = threading.Thread(target=self.heartbeat, daemon=True)
+                self.heartbeatThread.start()
+
+    def heartbeat(self):
+        """Touch the markers of the referenced files, so that other hosts do not take them for stale"""
+        while True:
+            time.sleep(METFILE_REF_HEARTBEAT_SECS)
+            with self.lock:
+                paths = list(self.refs)
+            for fullPath in paths:
+                try:
+                    os.utime(self.refMarkerPath(fullPath))
+                except OSError:
+                    # Released in the meantime
+                    pass
+
+    def removeRef(self, fullPath):
+        with self.lock:
+            self.refs[fullPath] -= 1
+            if self.refs[fullPath] <= 0:
+                del self.refs[fullPath]
+                if os.path.exists(self.refMarkerPath(fullPath)):
+                    os.remove(self.refMarkerPath(fullPath))
+
+    def isReferenced(self, fullPath):
+        """
+        True if this or another live process uses fullPath; markers of dead processes on this host,
+        ...and of other hosts that stopped touching them (see heartbeat), are deleted
+        """
+        with self.lock:
+            if self.refs[fullPath] > 0:
+                return True
+        hostname = socket.gethostname()
+        for marker in glob.glob(glob.escape(fullPath) + '.ref_*'):
+            host, _, pid = marker[len(fullPath) + len('.ref_'):].rpartition('_')
+            if host == hostname:
+                if isProcessAlive(int(pid)):
+                    return True
+            else:
+                try:
+                    if os.path.getmtime(marker) > time.time() - METFILE_REF_TIMEOUT_SECS:
+                        return True
+                except OSError:
+                    # Released in the meantime
+                    continue
+            sys.stdout.write('Deleting stale reference %s\n' % marker)
+            os.remove(marker)
+        return False
+
+    def evict(self):
+        """
+        Delete unreferenced unzipped files, least recently used first, until they fit in the disk budget
+        The directory is only scanned after this process added a file (every process evicts after its own fetches)
+        """
+        if self.diskBudgetBytes is None:
+            return
+        with self.lock:
+            if not self.needsEvict:
+                return
+            self.needsEvict = False
+        # Only unzipped copies can be deleted, since their .gz file stays
+        candidates = []
+        for gzPath in glob.glob(os.path.join(glob.escape(self.hrrrDir), 'hysplit.*.gz')):
+            try:
+                st = os.stat(gzPath[:-3])
+            except OSError:
+                continue
+            candidates.append((st.st_mtime, st.st_size, gzPath[:-3]))
+        total = sum(size for _, size, _ in candidates)
+        for _, size, fullPath in sorted(candidates):
+            if total <= self.diskBudgetBytes:
+                break
+            if self.tryRemove(fullPath):
+                total -= size
+        if total > self.diskBudgetBytes:
+            # Referenced files kept it over budget, so try again when they are released
+            with self.lock:
+                self.needsEvict = True
+
+    def tryRemove(self, fullPath):
+        """Delete fullPath unless it is referenced or being fetched (never waits for a lock)"""
+        pathLock = self.pathLock(fullPath)
+        if not pathLock.acquire(blocking=False):
+            return False
+        try:
+            with FileLock(fullPath + '.lock', timeout=0):
+                if self.isReferenced(fullPath):
+                    return False
+                sys.stdout.write('Deleting least recently used %s\n' % fullPath)
+                os.remove(fullPath)
+                return True
+        except Timeout:
+            return False
+        finally:
+            pathLock.release()
+
+    def fetchLocked(self, dt, fullPath):
+        """Called internally, with the locks of fullPath held"""
+        # Set first, so that an evict that is already scanning does not clear it before the file exists
+        with self.lock:
+            self.needsEvict = True
+        if os.path.exists(fullPath + '.gz'):
+            self.gunzip(fullPath)
+        if os.path.exists(fullPath):
+            return
+        if dt > HRRR_REFORMAT_TIME:
+            linkEnd = dt.strftime('%Y%m%d_%H-') + str(dt.hour + 5).zfill(2) + '_hrrr'
+            fileDownloaded = download_file(self.gcsUrl + 'noaa_arl_formatted/' + linkEnd, fullPath,
+                    circuit_breaker=self.gcsBreaker)
+            if not fileDownloaded:
+                sys.stdout.write('File not found in the Google Cloud Platform HRRR archive. Trying ARL FTP server...\n')
+                download_file(self.arlUrl + 'hrrr/' + linkEnd, fullPath, circuit_breaker=self.arlBreaker)
+        else:
+            download_file(self.arlUrl + 'hrrr.v1/' + hrrrFileName(dt), fullPath, circuit_breaker=self.arlBreaker)
+
+    def gunzip(self, fullPath):
+        """Unzip fullPath + '.gz' to fullPath; a truncated .gz is deleted so that the file is downloaded again"""
+        tmpPath = '%s_%d_%d.tmp' % (fullPath, os.getpid(), threading.get_ident())
+        try:
+            sys.stdout.write('Unzipping %s\n' % fullPath)
+            with gzip.open(fullPath + '.gz', 'rb') as f_in:
+                with open(tmpPath, 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+            os.rename(tmpPath, fullPath)
+        except EOFError:
+            sys.stdout.write('Unzip failed, redownloading %s\n' % fullPath)
+            os.remove(fullPath + '.gz')
+            os.remove(tmpPath)
+
+    def prefetch(self, dts):
+        """
+        Fetch the HRRR files for times dts in the background, in order, skipping the ones already queued
+        Files are fetched while fewer than prefetchAheadFiles prefetched files wait for their runs
+        """
+        with self.lock:
+            for dt in dts:
+                fullPath = self.path(dt)
+                if fullPath in self.prefetched or os.path.exists(fullPath):
+                    continue
+                self.prefetched.add(fullPath)
+                self.prefetchQueue.append(dt)
+        self.startPrefetches()
+
+    def startPrefetches(self):
+        with self.lock:
+            while (self.prefetchQueue and self.prefetchRunning < self.prefetchThreads and
+                    self.prefetchRunning + len(self.prefetchHeld) < self.prefetchAheadFiles):
+                self.prefetchRunning += 1
+                self.prefetchPool.submit(self.prefetchOne, self.prefetchQueue.popleft())
+
+    def prefetchOne(self, dt):
+        fullPath = self.path(dt)
+        try:
+            self.fetch(dt, addRef=True)
+            with self.lock:
+                self.prefetchHeld.add(fullPath)
+        except Exception:
+            # The run that needs the file will retry and raise
+            sys.stderr.write('Prefetching %s failed:\n%s' % (fullPath, traceback.format_exc()))
+            with self.lock:
+                self.prefetched.discard(fullPath)
+        finally:
+            with self.lock:
+                self.prefetchRunning -= 1
+        self.startPrefetches()
+
+    def releasePrefetched(self, dts):
+        """Drop the references that prefetch holds on the files for times dts, so they can be evicted again"""
+        released = []
+        with self.lock:
+            for dt in dts:
+                fullPath = self.path(dt)
+                if fullPath in self.prefetchHeld:
+                    self.prefetchHeld.discard(fullPath)
+                    self.prefetched.discard(fullPath)
+                    released.append(fullPath)
+        for fullPath in released:
+            self.removeRef(fullPath)
+        if released:
+            self.startPrefetches()
+
+
+def isProcessAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+_managers = {}
+_managersLock = threading.Lock()
+
+
+def getMetFileManager(hrrrDirPath, **kwargs):
+    """The MetFileManager of this process for the directory hrrrDirPath (kwargs are used when it is created)"""
+    hrrrDir = os.path.abspath(hrrrDirPath)
+    with _managersLock:
+        if hrrrDir not in _managers:
+            _managers[hrrrDir] = MetFileManager(hrrrDir, **kwargs)
+        return _managers[hrrrDir]
@@ -5,16 +5,23 @@ This code was taken and edited from the following path on the hal21 server:
 """
 
 
-import glob, os, array, datetime, dateutil.parser, math, random, re, json
+import glob, gzip, os, datetime, dateutil.parser, math, re, json, shutil, threading
 import numpy as np
 import pandas as pd
 
-from utils import subprocess_check, SimpleProcessPoolExecutor
+from utils import subprocess_check, SimpleProcessPoolExecutor, open_compressed_writer, COMPRESSION_EXTENSIONS, PeakRss
+from dispersion_cache_lib import updateRunFolderSize
 
 #adjust epoch to January 1, 2020 and scale from seconds to minutes for greater precision
 EPOCH_OFFSET = 1577836800
 EPOCH_SCALE = 60
 
+# Columns of PARTICLE.DAT that are needed to build bins, parsed with narrow dtypes
+PARTICLE_DAT_DTYPES = {'index': np.int32, 'time': np.float32, 'lat': np.float32, 'lon': np.float32, 'agl': np.float32}
+
+# Number of PARTICLE.DAT rows parsed at a time by iter_particle_dat_blocks
+PARTICLE_DAT_CHUNKSIZE = 1000000
+
 def gunzipFiles(fnames, zipfnames):
     for fname in zipfnames:
         if fname[:-3] not in fnames:
@@ -42,62 +49,91 @@ def findInFolder(folder, pattern):
         return False
 
 
-def parse_pardump(fname, rgb, filter_ratio=0.8, with_size=False):
-    # Process lines in the file
+def parse_pardump(fname, rgb, filter_ratio=0.8, with_size=False, chunksize=PARTICLE_DAT_CHUNKSIZE, seed=None):
+    """
+    Parse a text PARDUMP file (from par2asc) into bin records, using numpy instead of a per-line loop
+    The file has a header line per dump time (7 values: number of particles, number of pollutants,
+    ...year, month, day, hour, minute), then per particle a mass line, a position line (6 values: lat, lon,
+    ...height, sigma-h, and velocity sigmas), and a record line (5 values, the last one is the particle index)
+
+    Input:
+        fname: path to the text PARDUMP file
+        rgb: the color of the particles
+        filter_ratio: the ratio of records to drop (e.g., 0.8 means dropping 80% of the records)
+        with_size: if True, append the horizontal puff size in pixels to each record (for visualizing puffs)
+        chunksize: the number of lines to parse at a time
+        seed: seed for the random record dropping
+
+    Output:
+        a float32 array with one row per record, see the comment on RECORD_FLOATS
+        ...(with an extra column for the size if with_size is True)
+    """
     print("Process lines...")
-    points = {}
-    with open(fname, "r") as f:
-        for line in f:
-            try:
-                L = []
-                raw_line = line.rstrip().split(" ")
-                for l in raw_line:
-                    if l.rstrip() != '':
-                        if l.find('.') > -1:
-                            l = float(l)
-                        else:
-                            l = int(l)
-                        L.append(l)
-            except:
-                L = line
-            if len(L) == 7:
-                minute = L[6]
-                dt = datetime.datetime(2000 + L[2], L[3], L[4], L[5], L[6])
-                epoch = datetime_to_epoch(dt)
-            elif len(L) == 6:
-                x, y = lonlat_to_pixel_xy((L[1], L[0]))
-                z = float(L[2])
-                if with_size:
-                    sigh = sigh_to_pixel(float(l[3]), l[0])
-            elif len(L) == 5:
-                # This is where we can find the points
-                if random.random() > filter_ratio:
-                    idx = L[4]
-                    if idx not in points:
-                        points[idx] = []
-                    if minute % 5 == 0:
-                        if with_size:
-                            points[idx].append([x, y, z, epoch, sigh])
-                        else:
-                            points[idx].append([x, y, z, epoch])
-    # Process points
-    print("Process %d points obtained from the file" % len(points))
-    c = pack_color(rgb)
-    data = []
-    for idx in points:
-        p = points[idx]
-        if len(p) > 1:
-            for i in range(0, len(p) - 1):
-                p0 = p[i]
-                p1 = p[i+1]
-                # Each shader record in float32 is:
-                # x0, y0, z0, epoch0, x1, y1, z1, epoch1, packedColor
-                # x and y are in web mercator space 0,0 is NW 255,255 is SE
-                if with_size:
-                    data += [p0[0], p0[1], p0[2], p0[3], p1[0], p1[1], p1[2], p1[3], c, p1[4]]
-                else:
-                    data += [p0[0], p0[1], p0[2], p0[3], p1[0], p1[1], p1[2], p1[3], c]
-    return data
+    rng = np.random.default_rng(seed)
+    # The latest header and position line seen in previous chunks
+    last_epoch, last_minute = np.nan, np.nan
+    last_position = np.full(4, np.nan)
+    kept = []
+    reader = pd.read_csv(fname, sep=r'\s+', header=None, names=range(7), dtype=np.float64, chunksize=chunksize)
+    with reader:
+        for chunk in reader:
+            values = chunk.to_numpy()
+            counts = chunk.notna().sum(axis=1).to_numpy()
+            rows = np.arange(len(values))
+            header_rows = np.flatnonzero(counts == 7)
+            position_rows = np.flatnonzero(counts == 6)
+
+            epoch = np.full(len(values), np.nan)
+            minute = np.full(len(values), np.nan)
+            if len(header_rows):
+                h = values[header_rows].astype(np.int64)
+                year = np.where(h[:,2] < 100, 2000 + h[:,2], h[:,2])
+                dt = pd.to_datetime(pd.DataFrame({'year': year, 'month': h[:,3], 'day': h[:,4],
+                    'hour': h[:,5], 'minute': h[:,6]}))
+                epoch[header_rows] = (dt - pd.Timestamp(1970, 1, 1)).dt.total_seconds().to_numpy()
+                minute[header_rows] = h[:,6]
+
+            # Each record uses the latest header and position line before it, which may be in the previous chunk
+            records = np.flatnonzero(counts == 5)
+            latest_header = np.maximum.accumulate(np.where(counts == 7, rows, -1))[records]
+            latest_position = np.maximum.accumulate(np.where(counts == 6, rows, -1))[records]
+            record_epoch = np.where(latest_header >= 0, epoch[latest_header], last_epoch)
+            record_minute = np.where(latest_header >= 0, minute[latest_header], last_minute)
+            position = np.where((latest_position >= 0)[:,None], values[latest_position, :4], last_position)
+
+            keep = rng.random(len(records)) > filter_ratio
+            keep &= np.mod(record_minute, 5) == 0
+            keep &= ~np.isnan(position[:,0])
+            kept.append({
+                'index': values[records[keep], 4].astype(np.int64),
+                'position': position[keep],
+                'epoch': record_epoch[keep]})
+
+            if len(header_rows):
+                last_epoch, last_minute = epoch[header_rows[-1]], minute[header_rows[-1]]
+            if len(position_rows):
+                last_position = values[position_rows[-1], :4]
+
+    index = np.concatenate([k['index'] for k in kept] + [np.zeros(0, dtype=np.int64)])
+    position = np.concatenate([k['position'] for k in kept] + [np.zeros((0, 4))])
+    epoch = np.concatenate([k['epoch'] for k in kept] + [np.zeros(0)])
+    print("Process %d points of %d particles obtained from the file" % (len(index), len(np.unique(index))))
+
+    # Connect consecutive points of each particle (a stable sort keeps the file order, which is time order)
+    order = np.argsort(index, kind='stable')
+    index, position, epoch = index[order], position[order], epoch[order]
+    same = index[:-1] == index[1:]
+    lat, lon, z, sigh = position[:,0], position[:,1], position[:,2], position[:,3]
+    x, y = lonlat_to_pixel_xy_series((lon, lat))
+    p0 = np.flatnonzero(same)
+    p1 = p0 + 1
+    # Each shader record in float32 is:
+    # x0, y0, z0, epoch0, x1, y1, z1, epoch1, packedColor
+    # x and y are in web mercator space 0,0 is NW 255,255 is SE
+    columns = [x[p0], y[p0], z[p0], epoch[p0], x[p1], y[p1], z[p1], epoch[p1], np.full(len(p0), pack_color(rgb))]
+    if with_size:
+        columns.append(sigh_to_pixel_series(sigh[p1], lat[p1]))
+    return np.stack(columns, axis=1).astype(np.float32)
 
 
 def pack_color(color):
@@ -118,7 +154,11 @@ def lonlat_to_pixel_xy_series(lonlat):
 
 
 def sigh_to_pixel(sigh,lat):
-    return sigh / (157000.0 * abs(math.cos(lat)))
+    return sigh / (157000.0 * abs(math.cos(math.radians(lat))))
+
+
+def sigh_to_pixel_series(sigh, lat):
+    return sigh / (157000.0 * np.abs(np.cos(np.radians(lat))))
 
 
 def datetime_to_epoch(dt):
@@ -137,18 +177,193 @@ def create_bin(fnames, o_file, colormap):
     for fname in fnames:
         rgb = colormap[0][int(i*step)]
         print("Process %s" % fname)
-        points += parse_pardump(fname, rgb)
-        lines = []
+        points.append(parse_pardump(fname, rgb))
         i += 1
-    array.array('f', points).tofile(open(o_file, 'wb'))
-    points = []
+    with open(o_file, 'wb') as f:
+        np.concatenate(points).tofile(f)
+
+
+# Each bin record is x0, y0, z0, epoch0, x1, y1, z1, epoch1, packedColor in float32
+RECORD_FLOATS = 9
+RECORD_BYTES = RECORD_FLOATS * 4
+
+# Number of records that iter_merged_records sorts at a time
+MERGE_CHUNK_RECORDS = 1000000
+
+
+def _search_right(keys, start, bound, step):
+    """
+    Find the first position after start whose key is greater than bound
+    The window grows geometrically, so only a small part of a strided key column is copied for searchsorted
+    """
+    end = start
+    while True:
+        stop = min(len(keys), end + step)
+        window = keys[end:stop]
+        k = int(np.searchsorted(window, bound, side='right'))
+        if k < len(window) or stop == len(keys):
+            return end + k
+        end = stop
+        step *= 2
+
+
+def iter_merged_records(arrays, chunk_records=MERGE_CHUNK_RECORDS):
+    """
+    K-way merge of record arrays that are each sorted by their first timestamp (column 3)
+    Yields sorted chunks of about chunk_records records; records with equal timestamps stay in the same chunk
+    ...(in the order of arrays, so the output is deterministic), so a chunk also holds all the records that share
+    ...its last timestamp, and can be larger than chunk_records when many records have the same timestamp
+    """
+    keys = [a[:,3] for a in arrays]
+    cursors = [0] * len(arrays)
+    step = max(1, chunk_records // max(1, len(arrays)))
+    while True:
+        active = [i for i in range(len(arrays)) if cursors[i] < len(arrays[i])]
+        if not active:
+            return
+        # Take the records up to the smallest key that is step records ahead in some source
+        bound = min(keys[i][min(cursors[i] + step, len(keys[i])) - 1] for i in active)
+        parts = []
+        for i in active:
+            end = _search_right(keys[i], cursors[i], bound, step)
+            parts.append(arrays[i][cursors[i]:end])
+            cursors[i] = end
+        chunk = np.concatenate(parts)
+        yield chunk[np.argsort(chunk[:,3], kind='stable')]
+
+
+def compute_subset_index(tstamps, bucket_minutes=60):
+    """
+    Compute the subset index of a bin file in one pass
 
+    Input:
+        tstamps: sorted timestamps of the records (minutes, see EPOCH_OFFSET and EPOCH_SCALE),
+        ...or a list of sorted timestamp arrays that are merged into the bin file
+        bucket_minutes: the time span of each subset
 
-def create_multisource_bin(fnames, o_file, numSources, cmaps, filter_out_ratios=0.8):
+    Output:
+        a dict of numpy arrays, where subset i has the records first[i]...first[i]+count[i]-1
+        ...with timestamps before epoch[i] (epoch seconds); empty subsets have a count of zero
+        The records after the last full bucket are not indexed, as in the original per-bucket loop
+    """
+    if not isinstance(tstamps, list):
+        tstamps = [tstamps]
+    tstamps = [t for t in tstamps if len(t) > 0]
+    if not tstamps:
+        boundaries = np.zeros(0, dtype=np.int64)
+    else:
+        first = int(min(t[0] for t in tstamps))
+        last = int(max(t[-1] for t in tstamps))
+        boundaries = np.arange(first + bucket_minutes, last, bucket_minutes, dtype=np.int64)
+    # The position of a boundary in the merged records is the sum of its positions in each sorted array
+    ends = np.zeros(len(boundaries), dtype=np.int64)
+    for t in tstamps:
+        ends += np.searchsorted(t, boundaries, side='left')
+    starts = np.concatenate([[0], ends[:-1]]).astype(np.int64)
+    return {
+        'epoch': boundaries * EPOCH_SCALE + EPOCH_OFFSET,
+        'first': starts,
+        'count': ends - starts}
+
+
+# Record layout of the binary subset index written next to the .json index
+SUBSET_INDEX_DTYPE = np.dtype([('epoch', '<u4'), ('first', '<u4'), ('count', '<u4')])
+
+
+def write_subset_index(subsets, o_file, binary=False):
+    """Write the subset index as o_file with a .json extension (and optionally as .index.bin)"""
+    records = [{'epoch': int(e), 'first': int(f), 'count': int(c)}
+            for e, f, c in zip(subsets['epoch'], subsets['first'], subsets['count'])]
+    with open(o_file[:-4] + ".json", 'w') as f:
+        json.dump(records, f)
+    if binary:
+        index = np.empty(len(records), dtype=SUBSET_INDEX_DTYPE)
+        for c in SUBSET_INDEX_DTYPE.names:
+            index[c] = subsets[c]
+        index.tofile(o_file[:-4] + ".index.bin")
+
+
+# Rough memory costs used by plan_bin_memory
+PARSE_BYTES_PER_ROW = 200 # pandas parsing one row of a chunk
+BUILD_BYTES_PER_KEPT_ROW = 300 # DataFrame, df_to_bin and sorting for one row that survives filtering
+MIN_CHUNKSIZE = 10000
+
+# Default cap on the parsing processes of one bin file (the size of the pool before files were parsed in parallel),
+# ...since several bin files and the hysplit runs share the CPUs
+MAX_PARSE_WORKERS = 10
+
+
+def estimate_particle_file_rows(filename):
+    """Rough number of rows in a PARTICLE.DAT or PARDUMP file, from the sidecar or the file size"""
+    try:
+        with open(os.path.join(particle_dat_sidecar_path(filename), 'meta.json')) as f:
+            return json.load(f)['rows']
+    except (OSError, ValueError, KeyError):
+        pass
+    size = os.path.getsize(filename) if os.path.exists(filename) else 0
+    if os.path.basename(filename).startswith('PARDUMP'):
+        # About 76 bytes per particle in the binary records, and a gzipped dump is about a third of that
+        return size // (25 if filename.endswith('.gz') else 76)
+    # About 50 characters per line of text
+    return size // 50
+
+
+def plan_bin_memory(filenames, filter_outs, memory_budget_bytes, max_workers):
+    """
+    Split a memory budget between the workers that parse files and the final merge and write
+
+    Input:
+        filenames: the particle files of all sources
+        filter_outs: the filter_out ratio of each file
+        memory_budget_bytes: the total budget
+        max_workers: the largest number of parsing processes to use
+
+    Output:
+        a dict with "workers" (number of parsing processes), "chunksize" (rows parsed at a time),
+        ..."merge_chunk_records" (records merged at a time), and "spill" (True if the parsed records should be
+        ...handed over on disk instead of in shared memory)
+    """
+    kept_rows = []
+    for f, r in zip(filenames, filter_outs):
+        # The fraction of dumps that subsampling keeps, see read_particle_file
+        cadence = particle_file_cadence_minutes(f)
+        kept_rows.append(estimate_particle_file_rows(f) * cadence / max(cadence, subsample_for_cadence(cadence)) * (1 - r))
+    # A quarter for the records handed over in shared memory, a quarter for the merge, and half for the workers
+    spill = sum(kept_rows) * RECORD_BYTES > memory_budget_bytes // 4
+    merge_chunk_records = int(min(MERGE_CHUNK_RECORDS, max(MIN_CHUNKSIZE, memory_budget_bytes // 4 // (RECORD_BYTES * 4))))
+    largest_file_bytes = max(kept_rows + [0]) * BUILD_BYTES_PER_KEPT_ROW
+    workers = max(1, min(max_workers, len(filenames)))
+    while True:
+        chunksize = (memory_budget_bytes // 2 // workers - largest_file_bytes) // PARSE_BYTES_PER_ROW
+        if chunksize >= MIN_CHUNKSIZE or workers == 1:
+            break
+        workers -= 1
+    if chunksize < MIN_CHUNKSIZE:
+        print("Memory budget of %d bytes is too small for the largest file, expect to exceed it" % memory_budget_bytes)
+    chunksize = int(min(PARTICLE_DAT_CHUNKSIZE, max(MIN_CHUNKSIZE, chunksize)))
+    plan = {'workers': workers, 'chunksize': chunksize, 'merge_chunk_records': merge_chunk_records, 'spill': spill}
+    print("Plan for memory budget of %d bytes: %s" % (memory_budget_bytes, plan))
+    return plan
+
+
+def create_multisource_bin(fnames, o_file, numSources, cmaps, filter_out_ratios=0.8, bucket_minutes=60, binary_index=False,
+        memory_budget_bytes=None, merge_chunk_records=MERGE_CHUNK_RECORDS,
+        compression='gzip', compression_level=9, compression_threads=None, max_workers=None, source_lonlats=None):
     """
     Coloring based on source
     filter_out_ratios=0.8 means that 80% of the points will be dropped. if specified as a dict, filter ratios are applied per source.
     with_size=True means visualizing puffs instead of particles
+    bucket_minutes is the time span of each subset in the .json index, see compute_subset_index
+    binary_index=True also writes the subset index as a compact .index.bin file
+    memory_budget_bytes: if set, pick the number of parsing workers, the parsing and merging chunk sizes,
+    ...and whether to hand the parsed records over on disk, to stay within this many bytes (see plan_bin_memory)
+    merge_chunk_records: the number of records merged and compressed at a time
+    compression: "gzip" writes o_file + ".gz" (what EarthTime loads), "zstd" writes o_file + ".zst", None writes o_file
+    compression_level, compression_threads: passed to utils.open_compressed_writer
+    max_workers: the number of processes that parse files in parallel (default is the number of CPUs,
+    ...up to MAX_PARSE_WORKERS); lower it when several bin files are created at the same time
+    source_lonlats: for runs of a DispersionSourceGroup, the (lon, lat) of each source; every file in fnames then
+    ...holds all sources, and particles are split per source (see particle_group_file_to_bin)
     """
     runTimeHrs = int(len(fnames) / numSources)
 
@@ -158,96 +373,466 @@ def create_multisource_bin(fnames, o_file, numSources, cmaps, filter_out_ratios=
         filter_dict = True
 
     print("Only use %s of all the points to reduce file size" % filter_out_ratios)
-    maxWorkers = 10
-    pool = SimpleProcessPoolExecutor(maxWorkers)
-    for i in range(numSources):
+    jobs = []
+    if source_lonlats is not None:
+        # Every file holds the particles of all sources
+        filter_outs = filter_out_ratios if filter_dict else [filter_out_ratios] * numSources
+        jobs = [(particle_group_file_to_bin, filename, (cmaps, filter_outs, source_lonlats), min(filter_outs))
+                for filename in fnames]
+    for i in range(numSources if source_lonlats is None else 0):
         start_file = i * runTimeHrs
         single_source = fnames[start_file:start_file+runTimeHrs]
         rgb = cmaps[i]
         filter_out = filter_out_ratios[i] if filter_dict else filter_out_ratios
+        jobs += [(particle_file_to_bin, filename, (rgb, filter_out), filter_out) for filename in single_source]
+
+    maxWorkers = max_workers or min(MAX_PARSE_WORKERS, os.cpu_count() or 1)
+    chunksize = PARTICLE_DAT_CHUNKSIZE
+    scratch_dir = None
+    if memory_budget_bytes is not None:
+        plan = plan_bin_memory([j[1] for j in jobs], [j[3] for j in jobs], memory_budget_bytes, maxWorkers)
+        maxWorkers, chunksize = plan['workers'], plan['chunksize']
+        merge_chunk_records = min(merge_chunk_records, plan['merge_chunk_records'])
+        if plan['spill']:
+            # Workers hand their records back as memory-mapped files next to the output (an external sort)
+            scratch_dir = os.path.dirname(os.path.abspath(o_file))
+
+    pool = SimpleProcessPoolExecutor(maxWorkers, share_arrays=True, scratch_dir=scratch_dir)
+    # One job per hysplit run file, so that even a single source keeps every worker busy
+    for fn, filename, args, _ in jobs:
+        pool.submit(fn,filename,*args,chunksize=chunksize)
 
-        pool.submit(particle_dat_to_bin,single_source,rgb,filter_out)
-    
     all_points = pool.shutdown()
-    points = np.concatenate(all_points)
+    total = sum(len(p) for p in all_points)
+    print("Merging %d records from %d files" % (total, len(all_points)))
 
     #construct subset dir
+    subsets = compute_subset_index([p[:,3] for p in all_points], bucket_minutes=bucket_minutes)
+    write_subset_index(subsets, o_file, binary=binary_index)
+
+    #merge the per-source records, which are already sorted by first timestamp, straight into the compressed file
+    out_file = o_file + COMPRESSION_EXTENSIONS[compression]
+    tmp_file = '%s_%d.tmp' % (out_file, os.getpid())
+    print("Writing %s with %s compression" % (out_file, compression))
+    try:
+        with PeakRss('Merging and writing %s' % out_file):
+            with open_compressed_writer(tmp_file, compression=compression, level=compression_level,
+                    threads=compression_threads) as f:
+                for chunk in iter_merged_records(all_points, chunk_records=merge_chunk_records):
+                    f.write(chunk)
+        os.rename(tmp_file, out_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    print("Successfully wrote %s" % out_file)
+
+
+class ParticleFilter:
+    """
+    Apply the time subsampling and particle dropping of read_particle_dat one chunk at a time
+    State is kept per particle index (not per row), so memory does not grow with the file length
+    Rows must arrive in time order, which is how HYSPLIT writes PARTICLE.DAT
+    """
+    def __init__(self, filter_out=.5, subsample=10, seed=None):
+        assert(filter_out < 1)
+        self.filter_out = filter_out
+        self.subsample = subsample
+        self.rng = np.random.default_rng(seed)
+        self.first_time = np.zeros(0, dtype=np.float32)
+        self.keep = np.zeros(0, dtype=bool)
+
+    def _grow(self, max_index):
+        if max_index < len(self.keep):
+            return
+        n = max(max_index + 1, 2 * len(self.keep))
+        first_time = np.full(n, np.inf, dtype=np.float32)
+        first_time[:len(self.first_time)] = self.first_time
+        keep = np.zeros(n, dtype=bool)
+        keep[:len(self.keep)] = self.keep
+        # Decide once per particle index whether it is kept, so each trajectory is kept or dropped as a whole
+        keep[len(self.keep):] = self.rng.random(n - len(self.keep)) >= self.filter_out
+        self.first_time, self.keep = first_time, keep
+
+    def __call__(self, index, time):
+        """Return a boolean mask of the rows to keep"""
+        if len(index) == 0:
+            return np.zeros(0, dtype=bool)
+        self._grow(int(index.max()))
+        np.minimum.at(self.first_time, index, time)
+        mask = self.keep[index]
+        if self.subsample > 1:
+            mask &= np.mod(time, self.subsample) == np.mod(self.first_time[index], self.subsample)
+        return mask
+
+
+def particle_dat_start_time(particle_dat_filename):
+    """Get the run start time (epoch seconds) from the cache path of a PARTICLE.DAT file"""
+    return dateutil.parser.parse(re.search(
+        r'\d{8}_\d{6}-\d{4}', particle_dat_filename).group(0).replace('_', ' ')).timestamp()
+
+
+def particle_dat_sidecar_path(particle_dat_filename):
+    """The sidecar folder caches the parsed columns of a PARTICLE.DAT file as raw memory-mappable arrays"""
+    return particle_dat_filename + '.columns'
+
+
+def particle_dat_signature(particle_dat_filename):
+    """Size and modification time of a PARTICLE.DAT file, used to invalidate its sidecar"""
+    st = os.stat(particle_dat_filename)
+    return {'source_size': st.st_size, 'source_mtime_ns': st.st_mtime_ns}
+
+
+def open_particle_dat_sidecar(particle_dat_filename):
+    """Memory-map the cached columns of a PARTICLE.DAT file, or return None if the sidecar is missing or stale"""
+    sidecar_path = particle_dat_sidecar_path(particle_dat_filename)
+    try:
+        with open(os.path.join(sidecar_path, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # Keep using the sidecar if the text file was deleted, since there is nothing to compare against
+    if os.path.exists(particle_dat_filename):
+        signature = particle_dat_signature(particle_dat_filename)
+        if any(meta.get(k) != v for k, v in signature.items()):
+            print('Sidecar %s is stale' % sidecar_path)
+            return None
+    columns = {}
+    for c, dtype in PARTICLE_DAT_DTYPES.items():
+        if meta['rows'] == 0:
+            columns[c] = np.zeros(0, dtype=dtype)
+        else:
+            columns[c] = np.memmap(os.path.join(sidecar_path, c + '.bin'), dtype=dtype, mode='r', shape=(meta['rows'],))
+    return columns
+
+
+class ParticleDatSidecarWriter:
+    """
+    Write the parsed columns of a PARTICLE.DAT file chunk by chunk into a temp folder,
+    ...and then publish the folder atomically by renaming it to the sidecar path
+    """
+    def __init__(self, particle_dat_filename):
+        self.particle_dat_filename = particle_dat_filename
+        self.signature = particle_dat_signature(particle_dat_filename)
+        self.path = particle_dat_sidecar_path(particle_dat_filename)
+        self.tmp_path = '%s_%d_%d.tmp' % (self.path, os.getpid(), threading.get_ident())
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+        self.files = {c: open(os.path.join(self.tmp_path, c + '.bin'), 'wb') for c in PARTICLE_DAT_DTYPES}
+        self.rows = 0
+
+    def write(self, columns):
+        for c, f in self.files.items():
+            columns[c].astype(PARTICLE_DAT_DTYPES[c], copy=False).tofile(f)
+        self.rows += len(columns['index'])
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        with open(os.path.join(self.tmp_path, 'meta.json'), 'w') as f:
+            json.dump(dict(self.signature, rows=self.rows), f)
+        # Replace a stale sidecar; if the rename still fails, another process published first
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path, ignore_errors=True)
+        try:
+            os.rename(self.tmp_path, self.path)
+            print('Wrote sidecar %s with %d records' % (self.path, self.rows))
+        except OSError:
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+            return
+        try:
+            # The sidecar is part of the run folder, so the garbage collection must count it
+            updateRunFolderSize(os.path.dirname(self.particle_dat_filename))
+        except Exception as e:
+            # The manifest can be rebuilt from the cache folder, so a failure here must not fail the bin
+            print('Received exception %s while updating the size of %s in the dispersion cache manifest' % (
+                e, os.path.dirname(self.particle_dat_filename)))
+
+    def abort(self):
+        for f in self.files.values():
+            f.close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+
+def iter_particle_dat_chunks(particle_dat_filename, chunksize=PARTICLE_DAT_CHUNKSIZE, use_sidecar=True):
+    """
+    Yield unfiltered column chunks of a PARTICLE.DAT file, in file order
+    Chunks come from the sidecar when it is valid; otherwise the text is parsed and the sidecar is written on the way
+    """
+    columns = open_particle_dat_sidecar(particle_dat_filename) if use_sidecar else None
+    if columns is not None:
+        num_rows = len(columns['index'])
+        for start in range(0, num_rows, chunksize):
+            yield {c: np.asarray(a[start:start+chunksize]) for c, a in columns.items()}
+        return
+
+    writer = None
+    if use_sidecar:
+        try:
+            writer = ParticleDatSidecarWriter(particle_dat_filename)
+        except OSError as e:
+            print('Cannot write sidecar for %s: %s' % (particle_dat_filename, e))
+    reader = pd.read_csv(particle_dat_filename, sep=r'\s+', usecols=list(PARTICLE_DAT_DTYPES),
+            dtype=PARTICLE_DAT_DTYPES, chunksize=chunksize)
+    try:
+        with reader:
+            for chunk in reader:
+                columns = {c: chunk[c].to_numpy() for c in PARTICLE_DAT_DTYPES}
+                if writer:
+                    try:
+                        writer.write(columns)
+                    except OSError as e:
+                        print('Cannot write sidecar for %s: %s' % (particle_dat_filename, e))
+                        writer.abort()
+                        writer = None
+                yield columns
+    except BaseException:
+        if writer:
+            writer.abort()
+        raise
+    if writer:
+        writer.close()
+
+
+def iter_particle_dat_blocks(particle_dat_filename, filter_out=.5, subsample=10, chunksize=PARTICLE_DAT_CHUNKSIZE,
+        seed=None, use_sidecar=True):
+    """
+    Read a PARTICLE.DAT file in fixed-size chunks and yield the rows that survive filtering
+
+    Input:
+        particle_dat_filename: path to the PARTICLE.DAT file (inside the cache folder of the hysplit run)
+        filter_out: the ratio of particle indices to drop (e.g., 0.8 means dropping 80% of the particles)
+        subsample: keep one of every subsample timesteps of each particle
+        chunksize: the number of rows to parse at a time (this bounds the peak memory)
+        seed: seed for the random particle dropping
+        use_sidecar: if True, read from (or create) the binary sidecar instead of parsing the text each time
+
+    Output:
+        a generator of dicts that map "index" (int32), "lat", "lon", "agl" (float32),
+        ...and "time" (float64 epoch seconds, which does not fit in float32) to numpy arrays
+    """
+    start_datetime = particle_dat_start_time(particle_dat_filename)
+    particle_filter = ParticleFilter(filter_out=filter_out, subsample=subsample, seed=seed)
+    num_read, num_kept = 0, 0
+    for chunk in iter_particle_dat_chunks(particle_dat_filename, chunksize=chunksize, use_sidecar=use_sidecar):
+        index = chunk['index']
+        time = chunk['time']
+        mask = particle_filter(index, time)
+        num_read += len(mask)
+        num_kept += int(mask.sum())
+        yield {
+            'index': index[mask],
+            'time': time[mask].astype(np.float64) * 60.0 + start_datetime,
+            'lat': chunk['lat'][mask],
+            'lon': chunk['lon'][mask],
+            'agl': chunk['agl'][mask]}
+    print(f'Read {num_read} records, kept {num_kept} after subsampling time by {subsample} '
+          f'and dropping {filter_out * 100}% of particle indices')
+
+
+def read_particle_dat(particle_dat_filename, filter_out = .5, subsample=10, chunksize=PARTICLE_DAT_CHUNKSIZE,
+        use_sidecar=True):
+    """
+    Read a PARTICLE.DAT file into a DataFrame sorted by particle index and time (see iter_particle_dat_blocks)
+    This is the in-memory convenience wrapper: it holds all the rows that survive filtering, and sorts them,
+    ...so its peak memory grows with the file (only iter_particle_dat_blocks is bounded by chunksize)
+    The bin path reads one run at a time with it, since connecting the positions of a particle needs the whole run,
+    ...and plan_bin_memory sizes the parallel workers for that
+    """
+    blocks = list(iter_particle_dat_blocks(particle_dat_filename, filter_out=filter_out,
+        subsample=subsample, chunksize=chunksize, use_sidecar=use_sidecar))
+    columns = {}
+    for c in PARTICLE_DAT_DTYPES:
+        columns[c] = np.concatenate([b[c] for b in blocks]) if blocks else np.zeros(0, dtype=PARTICLE_DAT_DTYPES[c])
+
+    # Sort by particle index and then by time, so that df_to_bin can connect consecutive rows
+    order = np.lexsort((columns['time'], columns['index']))
+    return pd.DataFrame({c: columns[c][order] for c in columns})
+
+def find_pardump(folder):
+    """Find the binary PARDUMP file of a hysplit run, preferring the uncompressed one over the gzipped one"""
+    names = [os.path.basename(f) for f in glob.glob(os.path.join(folder, 'PARDUMP.*'))]
+    for pattern in [r'PARDUMP\.[^.]+', r'PARDUMP\.[^.]+\.gz']:
+        matches = sorted(n for n in names if re.fullmatch(pattern, n))
+        if matches:
+            return os.path.join(folder, matches[0])
+    return False
+
+
+def pardump_particle_dtype(byteorder, num_mass, num_position):
+    """
+    Structured dtype of one particle in a PARDUMP file, including the Fortran record markers
+    Each particle is written as three unformatted records:
+        mass of each pollutant (float32)
+        latitude, longitude, height (m agl), sigma-h, and velocity sigmas (float32)
+        age (minutes), distribution, pollutant type, meteo grid, and sort index (int32)
+    """
+    i4, f4 = byteorder + 'i4', byteorder + 'f4'
+    return np.dtype([
+        ('m0', i4), ('mass', f4, (num_mass,)), ('m1', i4),
+        ('m2', i4), ('position', f4, (num_position,)), ('m3', i4),
+        ('m4', i4), ('age', i4), ('hdwp', i4), ('ptyp', i4), ('pgrd', i4), ('nsort', i4), ('m5', i4)])
+
+
+def _pardump_header(buf, byteorder):
+    """Parse the record that starts each dump: number of particles and pollutants, and the dump time (UTC)"""
+    header = np.frombuffer(buf, dtype=byteorder + 'i4', count=9)
+    if header[0] != 28 or header[8] != 28:
+        raise ValueError('Unexpected PARDUMP header record %s' % header)
+    numpar, numpol, iyr, imo, ida, ihr, imn = (int(v) for v in header[1:8])
+    if iyr < 100:
+        iyr += 2000
+    epoch = datetime.datetime(iyr, imo, ida, ihr, imn, tzinfo=datetime.timezone.utc).timestamp()
+    return numpar, numpol, epoch
+
+
+def _check_pardump_particles(particles, pardump_filename):
+    """Check the Fortran record markers of the first and last particle of a dump"""
+    for marker in ['m0', 'm5']:
+        for value in particles[marker][[0, -1]]:
+            if value <= 0:
+                raise ValueError('Corrupt particle records in %s' % pardump_filename)
+
+
+def iter_pardump_dumps(pardump_filename):
+    """
+    Read the Fortran unformatted records of a binary PARDUMP file, one dump time at a time
+    Uncompressed files are memory-mapped (zero-copy); gzipped files are decompressed as a stream
+
+    Output:
+        a generator of (epoch seconds of the dump, structured array with one row per particle)
+    """
+    header_size = 36
+    particle_dtype = None
+    if pardump_filename.endswith('.gz'):
+        with gzip.open(pardump_filename, 'rb') as f:
+            buf = f.read(header_size)
+            if len(buf) < header_size:
+                return
+            byteorder = '>' if np.frombuffer(buf, dtype='>i4', count=1)[0] == 28 else '<'
+            while len(buf) == header_size:
+                numpar, numpol, epoch = _pardump_header(buf, byteorder)
+                data = b''
+                if particle_dtype is None and numpar > 0:
+                    # The record markers of the first particle give the number of masses and position values
+                    data = f.read(4)
+                    num_mass = int(np.frombuffer(data, dtype=byteorder + 'i4')[0]) // 4
+                    data += f.read(num_mass * 4 + 8)
+                    num_position = int(np.frombuffer(data[-4:], dtype=byteorder + 'i4')[0]) // 4
+                    particle_dtype = pardump_particle_dtype(byteorder, num_mass, num_position)
+                if numpar > 0:
+                    size = numpar * particle_dtype.itemsize
+                    data += f.read(size - len(data))
+                    if len(data) != size:
+                        raise ValueError('Truncated PARDUMP file %s' % pardump_filename)
+                    particles = np.frombuffer(data, dtype=particle_dtype, count=numpar)
+                    _check_pardump_particles(particles, pardump_filename)
+                    yield epoch, particles
+                buf = f.read(header_size)
+        return
+
+    if os.path.getsize(pardump_filename) == 0:
+        return
+    mm = np.memmap(pardump_filename, dtype=np.uint8, mode='r')
+    byteorder = '>' if np.frombuffer(mm, dtype='>i4', count=1)[0] == 28 else '<'
+    offset = 0
+    while offset + header_size <= len(mm):
+        numpar, numpol, epoch = _pardump_header(mm[offset:offset + header_size], byteorder)
+        offset += header_size
+        if particle_dtype is None and numpar > 0:
+            num_mass = int(np.frombuffer(mm, dtype=byteorder + 'i4', count=1, offset=offset)[0]) // 4
+            num_position = int(np.frombuffer(mm, dtype=byteorder + 'i4', count=1,
+                offset=offset + num_mass * 4 + 8)[0]) // 4
+            particle_dtype = pardump_particle_dtype(byteorder, num_mass, num_position)
+        if numpar > 0:
+            if offset + numpar * particle_dtype.itemsize > len(mm):
+                raise ValueError('Truncated PARDUMP file %s' % pardump_filename)
+            particles = np.ndarray(shape=(numpar,), dtype=particle_dtype, buffer=mm, offset=offset)
+            _check_pardump_particles(particles, pardump_filename)
+            yield epoch, particles
+            offset += numpar * particle_dtype.itemsize
+
+
+def iter_pardump_blocks(pardump_filename, filter_out=.5, subsample=10, chunksize=PARTICLE_DAT_CHUNKSIZE, seed=None):
+    """
+    Read a binary PARDUMP file and yield the same filtered column blocks as iter_particle_dat_blocks,
+    ...plus the "age" (minutes since release) of each particle record
+    """
+    particle_filter = ParticleFilter(filter_out=filter_out, subsample=subsample, seed=seed)
+    columns = ['index', 'time', 'lat', 'lon', 'agl', 'age']
+    pending = []
+    num_pending = 0
+    num_read, num_kept = 0, 0
+    for epoch, particles in iter_pardump_dumps(pardump_filename):
+        index = particles['nsort']
+        # The filter works on minutes, relative to the bin epoch to stay exact in float32
+        minutes = np.full(len(particles), (epoch - EPOCH_OFFSET) / EPOCH_SCALE, dtype=np.float32)
+        mask = particle_filter(index, minutes)
+        num_read += len(mask)
+        num_kept += int(mask.sum())
+        position = particles['position'][mask]
+        pending.append({
+            'index': index[mask].astype(np.int32),
+            'time': np.full(len(position), epoch, dtype=np.float64),
+            'lat': position[:, 0].astype(np.float32),
+            'lon': position[:, 1].astype(np.float32),
+            'agl': position[:, 2].astype(np.float32),
+            'age': particles['age'][mask].astype(np.int32)})
+        num_pending += len(position)
+        if num_pending >= chunksize:
+            yield {c: np.concatenate([b[c] for b in pending]) for c in columns}
+            pending, num_pending = [], 0
+    if pending:
+        yield {c: np.concatenate([b[c] for b in pending]) for c in columns}
+    print(f'Read {num_read} records, kept {num_kept} after subsampling time by {subsample} '
+          f'and dropping {filter_out * 100}% of particle indices')
+
+
+def read_pardump(pardump_filename, filter_out=.5, subsample=10, chunksize=PARTICLE_DAT_CHUNKSIZE):
+    """Read a binary PARDUMP file into the same DataFrame as read_particle_dat"""
+    blocks = list(iter_pardump_blocks(pardump_filename, filter_out=filter_out, subsample=subsample, chunksize=chunksize))
+    if not blocks:
+        return pd.DataFrame({c: np.zeros(0, dtype=PARTICLE_DAT_DTYPES[c]) for c in PARTICLE_DAT_DTYPES})
+    columns = {c: np.concatenate([b[c] for b in blocks]) for c in blocks[0]}
+    order = np.lexsort((columns['time'], columns['index']))
+    return pd.DataFrame({c: columns[c][order] for c in columns})
+
+
+# Minutes between the positions of a particle in the bin file
+RENDER_INTERVAL_MINUTES = 10
+
+
+def particle_file_cadence_minutes(filename):
+    """Minutes between particle dumps of a hysplit run, from the _P<minutes> or _D<minutes> suffix of its cache folder (1 if none)"""
+    m = re.search(r'_[PD](\d+)(_|$)', os.path.basename(os.path.dirname(os.path.abspath(filename))))
+    return int(m.group(1)) if m else 1
+
+
+def subsample_for_cadence(cadence_minutes):
+    """
+    The subsample (in minutes, see ParticleFilter) that keeps about one position every RENDER_INTERVAL_MINUTES
+    Dumps that are already at least that far apart are all kept
+    """
+    steps = RENDER_INTERVAL_MINUTES // cadence_minutes
+    return 1 if steps <= 1 else steps * cadence_minutes
+
+
+def read_particle_file(filename, filter_out=.5, subsample=None, chunksize=PARTICLE_DAT_CHUNKSIZE):
+    """
+    Read either a binary PARDUMP file or a text PARTICLE.DAT file
+    subsample=None picks it from the dump cadence of the run (see subsample_for_cadence)
+    """
+    if subsample is None:
+        subsample = subsample_for_cadence(particle_file_cadence_minutes(filename))
+    if os.path.basename(filename).startswith('PARDUMP'):
+        return read_pardump(filename, filter_out=filter_out, subsample=subsample, chunksize=chunksize)
+    return read_particle_dat(filename, filter_out=filter_out, subsample=subsample, chunksize=chunksize)
 
-    #sort by first timestamp
-    points = points[points[:,3].argsort()]
-    tstamps = points[:,3]
-
-    subsets = []
-    first = int(min(tstamps))
-    last = int(max(tstamps))
-    last_index = 0
-
-    for t in range(first + 60,last,60):
-        subset_record = {}
-        next_index = np.where(tstamps == t)[0][0]
-        subset_record["epoch"] = int(datetime.datetime.fromtimestamp(tstamps[next_index] * EPOCH_SCALE + EPOCH_OFFSET).timestamp())
-        subset_record["first"] = int(last_index)
-        subset_record["count"] = int(next_index - last_index)
-        
-        subsets.append(subset_record)
-        last_index = next_index
-    
-    with open(o_file[:-4] + ".json", 'w') as f:
-        json.dump(subsets, f)
-    
-    print("Writing array to file %s" % o_file)
-    points.tofile(o_file)
-    print("Zipping bin file %s" % o_file)
-    cmd = "pigz -9 %s" % (o_file)
-    subprocess_check(cmd)
-    print("Successfully zipped %s" % o_file)
-
-
-def read_particle_dat(particle_dat_filename, filter_out = .5, subsample=10 ):
-    pardump_df = pd.read_csv(particle_dat_filename, delim_whitespace=True)
-    print(f'Read {len(pardump_df)} records')
-
-    pardump_df.sort_values(['index', 'time'], inplace=True)
-    min_times = pardump_df.groupby(by='index')['time'].min()
-    pardump_df = pd.merge(left=pardump_df,right=min_times,on='index',suffixes=['','_min'])
-    pardump_df = pardump_df[pardump_df['time'].mod(subsample) == pardump_df['time_min'].mod(subsample)]
-
-    print(f'{len(pardump_df)} records after subsampling time by {subsample}')
-
-    assert(filter_out < 1)
-    keep_ratio = 1 - filter_out
-    num_particles = pardump_df['index'].max()
-    keep_indxs = random.sample(range(1,num_particles),int(num_particles * keep_ratio))
-    pardump_df = pardump_df[pardump_df['index'].isin(keep_indxs)]
-    print(f'{len(pardump_df)} records after dropping {filter_out * 100}% of particle indices')
-
-    pardump_df['time'] = pardump_df['time'] * 60
-    start_datetime = dateutil.parser.parse(re.search(
-        r'\d{8}_\d{6}-\d{4}',particle_dat_filename).group(0).replace('_',' ')).timestamp()
-    pardump_df['time'] = pardump_df['time'] + start_datetime
-    print(start_datetime)
-    pardump_df.index = range(0, len(pardump_df))
-    return pardump_df
-
-def read_and_concat_particle_dat_files(filenames,filter_out):
-    dfs = []
-    index_offset = 0
-
-    for filename in filenames:
-        df: pd.DataFrame = read_particle_dat(filename,filter_out)
-        df['index'] += index_offset
-        print(f'Read {len(df)} records, indices {df["index"].min()} to {df["index"].max()}, from {filename}')
-        index_offset = df['index'].max()
-        dfs.append(df)
-
-    df = pd.concat(dfs)
-    print(f'Concatenated to {len(df)} records, indices {df["index"].min()} to {df["index"].max()}')
-    return df
 
 def df_to_bin(pardump_df, rgb):
     index = pardump_df['index'].to_numpy()
-    lat = pardump_df['lat'].to_numpy()
-    lon = pardump_df['lon'].to_numpy()
+    lat = pardump_df['lat'].to_numpy(np.float64)
+    lon = pardump_df['lon'].to_numpy(np.float64)
     alt = pardump_df['agl'].to_numpy()
     epochtime = ((pardump_df['time'] - EPOCH_OFFSET) / EPOCH_SCALE ).to_numpy()
     packed_color = pack_color(rgb)
@@ -260,7 +845,87 @@ def df_to_bin(pardump_df, rgb):
     records = newdf[newdf.particle_id0 == newdf.particle_id1]
     return records.drop(['particle_id0','particle_id1'],axis=1).to_numpy(np.float32)
 
-def particle_dat_to_bin(filenames,rgb,filter_out):
-    df = read_and_concat_particle_dat_files(filenames,filter_out)
-    df.reset_index(inplace=True)
-    return df_to_bin(df,rgb)
+def particle_file_to_bin(filename, rgb, filter_out, chunksize=PARTICLE_DAT_CHUNKSIZE):
+    """
+    Create the bin records of one hysplit run (PARTICLE.DAT or PARDUMP file), sorted by their first timestamp
+    Records only connect positions of the same particle, so the runs of a source can be processed independently
+    """
+    with PeakRss('Parsing %s' % filename):
+        df = read_particle_file(filename, filter_out, chunksize=chunksize)
+        print(f'Read {len(df)} records from {filename}')
+        records = df_to_bin(df, rgb)
+        return records[np.argsort(records[:,3], kind='stable')]
+
+
+# Assumed wind speed (m/s) near the ground, for how far a particle drifts before its first dump
+SOURCE_SPLIT_DRIFT_MPS = 5
+
+def max_source_split_cadence_minutes(source_lonlats, drift_mps=SOURCE_SPLIT_DRIFT_MPS):
+    """
+    The longest dump cadence (in minutes) at which nearest_source assigns particles to the right source:
+    ...a particle must drift less than half the distance between the two closest sources before its first dump
+    """
+    lonlats = np.asarray(source_lonlats, dtype=np.float64)
+    if len(lonlats) < 2:
+        return math.inf
+    lat = np.radians(lonlats[:,1].mean())
+    dx = (lonlats[:,None,0] - lonlats[None,:,0]) * 111320 * math.cos(lat)
+    dy = (lonlats[:,None,1] - lonlats[None,:,1]) * 110540
+    distance = np.sqrt(dx * dx + dy * dy)
+    min_distance = distance[np.triu_indices(len(lonlats), 1)].min()
+    return min_distance / 2 / drift_mps / 60
+
+def check_source_split(source_lonlats, cadence_minutes):
+    """Raise ValueError if the particles of a multi-source run with this dump cadence cannot be told apart"""
+    max_cadence = max_source_split_cadence_minutes(source_lonlats)
+    if cadence_minutes > max_cadence:
+        raise ValueError('Particles dumped every %d minutes can drift closer to another source before their first dump '
+                '(the closest sources allow at most %.1f minutes); lower the dump cadence or run one simulation per source'
+                % (cadence_minutes, max_cadence))
+
+def nearest_source(df, source_lonlats):
+    """
+    Assign each particle of a multi-source run to the source nearest to its first position
+    This is only reliable if the particles were dumped soon after their release (see check_source_split)
+
+    Input:
+        df: particle positions sorted by index, then time (see read_particle_file)
+        source_lonlats: (lon, lat) of each source, in the order of the run's CONTROL file
+
+    Output:
+        the source number of each row of df
+    """
+    index = df['index'].to_numpy()
+    if len(index) == 0:
+        return np.zeros(0, dtype=np.int32)
+    first_rows = np.flatnonzero(np.r_[True, index[1:] != index[:-1]])
+    lon = df['lon'].to_numpy(np.float64)[first_rows]
+    lat = df['lat'].to_numpy(np.float64)[first_rows]
+    source_lonlats = np.asarray(source_lonlats, dtype=np.float64)
+    dx = (lon[:,None] - source_lonlats[None,:,0]) * np.cos(np.radians(lat))[:,None]
+    dy = lat[:,None] - source_lonlats[None,:,1]
+    source_of_particle = np.argmin(dx * dx + dy * dy, axis=1).astype(np.int32)
+    return np.repeat(source_of_particle, np.diff(np.r_[first_rows, len(index)]))
+
+def particle_group_file_to_bin(filename, rgbs, filter_outs, source_lonlats, chunksize=PARTICLE_DAT_CHUNKSIZE, seed=None):
+    """
+    Create the bin records of one hysplit run of several sources (see DispersionSourceGroup), sorted by their first timestamp
+    Particles are split per source by nearest_source, and colored and filtered with the rgb and filter_out of their source
+    """
+    with PeakRss('Parsing %s' % filename):
+        # Read with the smallest filter ratio, then drop more particles of the sources with larger ones
+        min_filter_out = min(filter_outs)
+        df = read_particle_file(filename, min_filter_out, chunksize=chunksize)
+        print(f'Read {len(df)} records from {filename}')
+        source_of_row = nearest_source(df, source_lonlats)
+        rng = np.random.default_rng(seed)
+        parts = []
+        for i, (rgb, filter_out) in enumerate(zip(rgbs, filter_outs)):
+            source_df = df[source_of_row == i]
+            if filter_out > min_filter_out:
+                indices = np.unique(source_df['index'].to_numpy())
+                keep = indices[rng.random(len(indices)) < (1 - filter_out) / (1 - min_filter_out)]
+                source_df = source_df[source_df['index'].isin(keep)]
+            parts.append(df_to_bin(source_df, rgb))
+        records = np.concatenate(parts)
+        return records[np.argsort(records[:,3], kind='stable')]
@@ -5,7 +5,8 @@ This code was taken and edited from the following path on hal21 server (on Oct 2
 """
 
 
-import os, requests, concurrent, concurrent.futures, datetime, math, shutil, subprocess, sys, time, traceback, urllib
+import os, requests, collections, concurrent, concurrent.futures, datetime, errno, glob, math, shutil, signal, struct, subprocess, sys, tempfile, threading, time, traceback, urllib, zlib
+import numpy as np
 from requests.exceptions import RequestException
 from contextlib import closing
 
@@ -63,35 +64,307 @@ def subprocess_check(*args, **kwargs):
     return all
 
 
-def download_file(url, filename, timeout=3600):
+class SubprocessTimeout(Exception):
+    """A subprocess was killed because it exceeded its wall-clock or CPU time limit"""
+    pass
+
+
+class SubprocessCancelled(Exception):
+    """A subprocess was killed because its cancel event was set"""
+    pass
+
+
+SubprocessResult = collections.namedtuple('SubprocessResult', ['returncode', 'wall_secs', 'rusage', 'peak_rss_bytes'])
+
+# Seconds between SIGTERM and SIGKILL when a subprocess is stopped
+SUBPROCESS_KILL_GRACE_SECS = 10
+
+
+def process_cpu_secs(pid):
+    """User plus system CPU seconds of a running process, from /proc (None where it is not available)"""
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            # Fields after the command name, which is in parentheses and can contain spaces
+            fields = f.read().rpartition(')')[2].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def process_peak_rss_bytes(pid):
+    """
+    Peak resident memory of a running process (VmHWM in /proc), or None where it is not available
+    Unlike ru_maxrss of a child, it does not include the memory of the python parent that the child was forked from
+    """
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def stream_lines(stream, log_file, tail, on_line):
+    for line in iter(stream.readline, b''):
+        text = line.decode('utf8', 'replace')
+        if log_file is not None:
+            log_file.write(text)
+            log_file.flush()
+        tail.append(text)
+        if on_line is not None:
+            on_line(text)
+
+
+def run_streaming(args, log_file=None, cwd=None, wall_timeout_secs=None, cpu_timeout_secs=None, cancel_event=None,
+        on_line=None, poll_secs=1, ignore_error=False):
+    """
+    Run a subprocess, writing its stdout and stderr to log_file as they arrive instead of buffering them
+    The subprocess (and its children) is killed if it runs longer than wall_timeout_secs,
+    ...uses more than cpu_timeout_secs of CPU, or cancel_event (a threading.Event) is set
+
+    Input:
+        args: the command, as a list (or a string, which is run by the shell)
+        log_file: an open text file for the output, or None
+        on_line: if not None, called with each line of output (e.g., to parse progress)
+        poll_secs: how often the limits are checked and the peak memory is sampled
+
+    Output:
+        a SubprocessResult with the return code, the wall-clock seconds, the resource usage
+        ...(resource.struct_rusage with ru_utime and ru_stime; its ru_maxrss is at least the parent's memory on Linux),
+        ...and the peak resident bytes of the subprocess (without its children) sampled from /proc,
+        ...or None if it exited before the first sample
+    """
+    shell = type(args) == str
+    start = time.time()
+    p = subprocess.Popen(args, shell=shell, cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, start_new_session=True)
+    tail = collections.deque(maxlen=20)
+    reader = threading.Thread(target=stream_lines, args=(p.stdout, log_file, tail, on_line), daemon=True)
+    reader.start()
+    stop_reason, stop_time = None, None
+    peak_rss_bytes = None
+    while True:
+        # Sampled before the subprocess is reaped, since /proc of a zombie has no memory fields
+        rss_bytes = process_peak_rss_bytes(p.pid)
+        if rss_bytes is not None:
+            peak_rss_bytes = max(peak_rss_bytes or 0, rss_bytes)
+        # wait4 instead of Popen.poll, for the resource usage of the subprocess
+        pid, status, rusage = os.wait4(p.pid, os.WNOHANG)
+        if pid:
+            break
+        if stop_reason is None:
+            if cancel_event is not None and cancel_event.is_set():
+                stop_reason = SubprocessCancelled('%s was cancelled' % (args,))
+            elif wall_timeout_secs is not None and time.time() - start > wall_timeout_secs:
+                stop_reason = SubprocessTimeout('%s exceeded its wall-clock limit of %gs' % (args, wall_timeout_secs))
+            elif cpu_timeout_secs is not None and (process_cpu_secs(p.pid) or 0) > cpu_timeout_secs:
+                stop_reason = SubprocessTimeout('%s exceeded its CPU limit of %gs' % (args, cpu_timeout_secs))
+            if stop_reason is not None:
+                sys.stderr.write('Stopping subprocess %d: %s\n' % (p.pid, stop_reason))
+                stop_time = time.time()
+                kill_process_group(p.pid, signal.SIGTERM)
+        elif time.time() - stop_time > SUBPROCESS_KILL_GRACE_SECS:
+            kill_process_group(p.pid, signal.SIGKILL)
+        time.sleep(poll_secs)
+    # Tell Popen that the subprocess was reaped
+    p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    reader.join()
+    p.stdout.close()
+    if stop_reason is not None:
+        raise stop_reason
+    if p.returncode != 0 and not ignore_error:
+        raise Exception('Call to run_streaming failed with return code %d\nLast lines of output:\n%s' % (
+            p.returncode, ''.join(tail)))
+    return SubprocessResult(p.returncode, time.time() - start, rusage, peak_rss_bytes)
+
+
+def kill_process_group(pid, sig):
+    try:
+        os.killpg(pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+PARALLEL_DOWNLOAD_MIN_BYTES = 64 * 1024 * 1024
+
+
+class DownloadError(Exception):
+    """A download attempt failed in a way that may succeed if retried"""
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stop calling a failing server for a while
+    After failure_threshold failures in a row the breaker opens and allow() returns False,
+    ...then after reset_timeout seconds one trial call is allowed, which closes the breaker if it succeeds
+    Usage:
+        gcs = CircuitBreaker('GCS')
+        download_file(url, filename, circuit_breaker=gcs)
+    """
+    def __init__(self, name, failure_threshold=3, reset_timeout=300):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.reset_timeout:
+                # Let one trial call through; the breaker reopens for another reset_timeout if it fails
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                sys.stdout.write('Circuit breaker %s closed\n' % self.name)
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    sys.stdout.write('Circuit breaker %s opened after %d failures\n' % (self.name, self.failures))
+                self.opened_at = time.time()
+
+
+def download_file(url, filename, timeout=3600, retries=4, backoff_secs=2, parallel=4, circuit_breaker=None):
+    """
+    Download url to filename, unless filename already exists
+
+    HTTP downloads are streamed to filename + '.tmp', continue a partial .tmp file left by an earlier attempt,
+    ...and files of at least PARALLEL_DOWNLOAD_MIN_BYTES are split into parallel byte-range requests
+    ...if the server supports ranges. Failed attempts are retried with exponential backoff.
+
+    Input:
+        retries: the number of retries after the first attempt
+        backoff_secs: the wait before the first retry, doubled for every retry
+        parallel: the number of concurrent byte-range requests for large files
+        circuit_breaker: if not None, a CircuitBreaker for the server of url; nothing is downloaded while it is open
+
+    Output:
+        True if the file exists or was downloaded, False if the server does not have it,
+        ...the circuit breaker is open, or all attempts failed
+    """
     if os.path.exists(filename):
         sys.stdout.write('%s already downloaded\n' % filename)
         return True
-    else:
-        if not os.path.exists(os.path.dirname(filename)):
-            os.makedirs(os.path.dirname(filename))
+    if circuit_breaker is not None and not circuit_breaker.allow():
+        sys.stdout.write('Skipping %s because circuit breaker %s is open\n' % (url, circuit_breaker.name))
+        return False
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    tmp_filename = filename + '.tmp'
+    for attempt in range(retries + 1):
         sys.stdout.write('Downloading %s to %s\n' % (url, filename))
-        
-        if url.startswith('ftp'):
-            with closing(urllib.request.urlopen(url,timeout=timeout)) as r:
-                with open(filename + '.tmp', 'wb') as f:
-                    shutil.copyfileobj(r, f)
-            sys.stdout.write('Done, wrote file to %s\n' % (filename))
-        else:
-        
-            try:
-                response = requests.Session().get(url, timeout=timeout)
-                if(response.status_code!=200):
-                    print('Error response, code = %d, body = %s' % (response.status_code, response.text))
-                    return False
-            except RequestException as e:
-                sys.stdout.write("Couldn't read %s because %s" % (url, e))
+        try:
+            if url.startswith('ftp'):
+                download_ftp(url, tmp_filename, timeout)
+            elif not download_http(url, tmp_filename, timeout, parallel):
+                # A missing file is an answer from a working server, not a failure
+                if circuit_breaker is not None:
+                    circuit_breaker.record_success()
                 return False
+            os.rename(tmp_filename, filename)
+            sys.stdout.write('Done, wrote %d bytes to %s\n' % (os.path.getsize(filename), filename))
+            if circuit_breaker is not None:
+                circuit_breaker.record_success()
+            return True
+        except Exception as e:
+            sys.stdout.write("Couldn't read %s because %s (attempt %d of %d)\n" % (url, e, attempt + 1, retries + 1))
+            if attempt < retries:
+                time.sleep(backoff_secs * 2 ** attempt)
+    if circuit_breaker is not None:
+        circuit_breaker.record_failure()
+    return False
+
+
+def download_ftp(url, tmp_filename, timeout):
+    """Stream url to tmp_filename (urllib cannot resume FTP transfers, so every attempt starts over)"""
+    with closing(urllib.request.urlopen(url, timeout=timeout)) as r:
+        with open(tmp_filename, 'wb') as f:
+            shutil.copyfileobj(r, f, DOWNLOAD_CHUNK_BYTES)
+
+
+def download_http(url, tmp_filename, timeout, parallel=4):
+    """
+    Stream url to tmp_filename, resuming or splitting into byte ranges where possible
+    Returns False if the server does not have the file, and raises DownloadError for errors worth retrying
+    """
+    with requests.Session() as session:
+        head = session.head(url, timeout=timeout, allow_redirects=True)
+    if head.status_code == 405:
+        # HEAD not allowed, so nothing is known about the size or ranges
+        size, ranges = None, False
+    elif 400 <= head.status_code < 500:
+        print('Error response, code = %d, url = %s' % (head.status_code, url))
+        return False
+    elif head.status_code != 200:
+        raise DownloadError('HTTP status %d' % head.status_code)
+    else:
+        size = int(head.headers['Content-Length']) if 'Content-Length' in head.headers else None
+        ranges = head.headers.get('Accept-Ranges') == 'bytes' and size is not None
 
-            open(filename + '.tmp', "wb").write(response.content)
-            sys.stdout.write('Done, wrote %d bytes to %s\n' % (len(response.content), filename))
-        os.rename(filename + '.tmp', filename)
-        return True
+    if ranges and os.path.exists(tmp_filename) and os.path.getsize(tmp_filename) > size:
+        os.remove(tmp_filename)
+    if ranges and parallel > 1 and size >= PARALLEL_DOWNLOAD_MIN_BYTES and not os.path.exists(tmp_filename):
+        download_http_parallel(url, tmp_filename, timeout, size, parallel)
+    else:
+        download_http_part(url, tmp_filename, timeout, 0, size if ranges else None, resume=ranges)
+    if size is not None and os.path.getsize(tmp_filename) != size:
+        raise DownloadError('Downloaded %d of %d bytes' % (os.path.getsize(tmp_filename), size))
+    return True
+
+
+def download_http_part(url, path, timeout, start=0, end=None, resume=True):
+    """Stream bytes start to end-1 of url (to the end of the file if end is None) into path, after the bytes already in path"""
+    done = os.path.getsize(path) if resume and os.path.exists(path) else 0
+    if end is not None and start + done >= end:
+        return
+    headers = {}
+    if resume and (start + done > 0 or end is not None):
+        headers['Range'] = 'bytes=%d-%s' % (start + done, '' if end is None else end - 1)
+    with requests.Session() as session:
+        with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+            if response.status_code == 200 and start + done > 0:
+                raise DownloadError('Server ignored the range request for %s' % url)
+            if response.status_code not in (200, 206):
+                raise DownloadError('HTTP status %d' % response.status_code)
+            with open(path, 'ab' if done else 'wb') as f:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_BYTES):
+                    f.write(chunk)
+
+
+def download_http_parallel(url, tmp_filename, timeout, size, parallel):
+    """Download size bytes of url as parallel byte ranges, each in its own resumable .part file, then join them"""
+    part_size = int(math.ceil(size / parallel))
+    parts = [(start, min(start + part_size, size)) for start in range(0, size, part_size)]
+    part_paths = ['%s.%d-%d.part' % (tmp_filename, start, end) for start, end in parts]
+    # Parts left by an attempt with a different split cannot be reused
+    for path in glob.glob(glob.escape(tmp_filename) + '.*.part'):
+        if path not in part_paths:
+            os.remove(path)
+    pool = SimpleThreadPoolExecutor(len(parts))
+    for (start, end), path in zip(parts, part_paths):
+        pool.submit(download_http_part, url, path, timeout, start, end)
+    pool.shutdown()
+    with open(tmp_filename + '.joining', 'wb') as f:
+        for path in part_paths:
+            with open(path, 'rb') as part:
+                shutil.copyfileobj(part, f, DOWNLOAD_CHUNK_BYTES)
+    os.rename(tmp_filename + '.joining', tmp_filename)
+    for path in part_paths:
+        os.remove(path)
 
 
 def unzip_file(filename):
@@ -120,6 +393,28 @@ def gunzip_file(filename):
         sys.stdout.write('Success, created %s\n' % (dest))
 
 
+def publish_directory(src_dir, dest_dir):
+    """
+    Move the directory src_dir to dest_dir, so that other processes see dest_dir complete or not at all
+    os.rename is atomic but fails across filesystems, so then src_dir is copied to a temp directory
+    ...next to dest_dir (on the same filesystem), which is renamed to dest_dir before src_dir is deleted
+    """
+    try:
+        os.rename(src_dir, dest_dir)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    tmp_dir = '%s_%d_%d.tmp' % (dest_dir, os.getpid(), threading.get_ident())
+    try:
+        shutil.copytree(src_dir, tmp_dir)
+        os.rename(tmp_dir, dest_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    shutil.rmtree(src_dir)
+
+
 class SimpleThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
     """Raises worker exceptions in shutdown"""
     def __init__(self, max_workers):
@@ -137,9 +432,10 @@ class SimpleThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
     def shutdown(self):
         exception_count = 0
         results = []
-        for completed in concurrent.futures.as_completed(self.futures):
+        # Results are returned in submit order (not completion order), so that the output does not depend on timing
+        for future in self.futures:
             try:
-                results.append(completed.result())
+                results.append(future.result())
             except Exception:
                 exception_count += 1
                 sys.stderr.write(
@@ -153,13 +449,100 @@ class SimpleThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
         return results
 
 
+def default_scratch_dir():
+    """Scratch folder for handing arrays between processes; /dev/shm is a tmpfs, so its files live in shared memory"""
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+class SharedArrayHandle:
+    """
+    Picklable reference to a numpy array that a worker process saved to a scratch file
+    The parent memory-maps the file instead of receiving a pickled copy of the array through a pipe
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def attach(self):
+        """Memory-map the array and unlink its file (the mapping stays valid until the array is freed)"""
+        try:
+            return np.load(self.path, mmap_mode='r')
+        except ValueError:
+            # Empty arrays cannot be memory-mapped
+            return np.load(self.path)
+        finally:
+            os.remove(self.path)
+
+    def discard(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def share_arrays(result, scratch_dir):
+    """Replace numpy arrays in a result (or in a list or tuple result) by SharedArrayHandle objects"""
+    if isinstance(result, np.ndarray):
+        fd, path = tempfile.mkstemp(suffix='.npy', dir=scratch_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, result)
+        except BaseException:
+            os.remove(path)
+            raise
+        return SharedArrayHandle(path)
+    if isinstance(result, (list, tuple)):
+        shared = []
+        try:
+            for r in result:
+                shared.append(share_arrays(r, scratch_dir))
+        except BaseException:
+            discard_shared_arrays(shared)
+            raise
+        return type(result)(shared)
+    return result
+
+
+def attach_shared_arrays(result):
+    if isinstance(result, SharedArrayHandle):
+        return result.attach()
+    if isinstance(result, (list, tuple)):
+        return type(result)(attach_shared_arrays(r) for r in result)
+    return result
+
+
+def discard_shared_arrays(result):
+    if isinstance(result, SharedArrayHandle):
+        result.discard()
+    elif isinstance(result, (list, tuple)):
+        for r in result:
+            discard_shared_arrays(r)
+
+
+def call_and_share_arrays(scratch_dir, fn, args, kwargs):
+    """Run fn in a worker process and hand its numpy arrays back through scratch_dir"""
+    return share_arrays(fn(*args, **kwargs), scratch_dir)
+
+
 class SimpleProcessPoolExecutor(concurrent.futures.ProcessPoolExecutor):
-    def __init__(self, max_workers):
+    """
+    Raises worker exceptions in shutdown
+    With share_arrays=True, numpy arrays returned by workers are saved to files in scratch_dir
+    ...and memory-mapped by shutdown instead of being pickled back to the parent
+    """
+    def __init__(self, max_workers, share_arrays=False, scratch_dir=None):
         super(SimpleProcessPoolExecutor, self).__init__(max_workers=max_workers)
         self.futures = []
+        self.share_arrays = share_arrays
+        self.scratch_dir = None
+        if share_arrays:
+            # A private folder, so files left by workers that crashed can be removed in shutdown
+            self.scratch_dir = tempfile.mkdtemp(prefix='shared_arrays_', dir=scratch_dir or default_scratch_dir())
 
     def submit(self, fn, *args, **kwargs):
-        future = super(SimpleProcessPoolExecutor, self).submit(fn, *args, **kwargs)
+        if self.share_arrays:
+            future = super(SimpleProcessPoolExecutor, self).submit(call_and_share_arrays, self.scratch_dir, fn, args, kwargs)
+        else:
+            future = super(SimpleProcessPoolExecutor, self).submit(fn, *args, **kwargs)
         self.futures.append(future)
         return future
 
@@ -169,9 +552,10 @@ class SimpleProcessPoolExecutor(concurrent.futures.ProcessPoolExecutor):
     def shutdown(self):
         exception_count = 0
         results = []
-        for completed in concurrent.futures.as_completed(self.futures):
+        # Results are returned in submit order (not completion order), so that the output does not depend on timing
+        for future in self.futures:
             try:
-                results.append(completed.result())
+                results.append(future.result())
             except Exception:
                 exception_count += 1
                 sys.stderr.write(
@@ -179,8 +563,15 @@ class SimpleProcessPoolExecutor(concurrent.futures.ProcessPoolExecutor):
                     'Exception follows:\n' +
                     traceback.format_exc())
         super(SimpleProcessPoolExecutor, self).shutdown()
-        if exception_count:
-            raise Exception('SimpleProcessPoolExecutor failed: %d of %d raised exception' % (exception_count, len(self.futures)))
+        try:
+            if exception_count:
+                raise Exception('SimpleProcessPoolExecutor failed: %d of %d raised exception' % (exception_count, len(self.futures)))
+            if self.share_arrays:
+                results = [attach_shared_arrays(r) for r in results]
+        finally:
+            if self.share_arrays:
+                discard_shared_arrays(results)
+                shutil.rmtree(self.scratch_dir, ignore_errors=True)
         print('SimpleProcessPoolExecutor succeeded: all %d jobs completed' % len(self.futures))
         return results
 
@@ -190,6 +581,99 @@ class SimpleProcessPoolExecutor(concurrent.futures.ProcessPoolExecutor):
             os.kill(pid, signal)
 
 
+def deflate_block(block, zdict, level, last):
+    """Compress one block of a ParallelGzipWriter as raw deflate, ending on a byte boundary unless it is the last"""
+    if zdict:
+        c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 9)
+    return c.compress(block) + c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter:
+    """
+    Write a single-member gzip file, compressing blocks in parallel threads (the same scheme as pigz)
+    Each block is primed with the last 32 KB of the previous block and ends with a sync flush,
+    ...so the blocks join into one deflate stream that any gzip reader can decompress
+    Usage:
+        with ParallelGzipWriter('data.bin.gz', level=9, threads=8) as f:
+            f.write(array)
+    """
+    def __init__(self, path, level=9, threads=None, block_size=1024*1024):
+        self.file = open(path, 'wb')
+        self.level = level
+        self.block_size = block_size
+        threads = threads or os.cpu_count() or 1
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+        self.max_pending = 2 * threads
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.dictionary = b''
+        self.crc = 0
+        self.size = 0
+        # Header: magic, deflate, no flags, mtime, extra flags (2 is max compression), OS (3 is unix)
+        self.file.write(b'\x1f\x8b\x08\x00' + struct.pack('<I', int(time.time())) +
+                        (b'\x02' if level == 9 else b'\x00') + b'\x03')
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]), last=False)
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def _submit(self, block, last):
+        self.pending.append(self.pool.submit(deflate_block, block, self.dictionary, self.level, last))
+        self.dictionary = block[-32768:]
+        while len(self.pending) > self.max_pending:
+            self.file.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.file.closed:
+            return
+        try:
+            self._submit(bytes(self.buffer), last=True)
+            while self.pending:
+                self.file.write(self.pending.popleft().result())
+            self.file.write(struct.pack('<II', self.crc & 0xffffffff, self.size & 0xffffffff))
+        finally:
+            self.pool.shutdown()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.pool.shutdown(cancel_futures=True)
+            self.file.close()
+
+
+def open_compressed_writer(path, compression='gzip', level=9, threads=None):
+    """
+    Open a file for streaming compressed output
+    compression can be "gzip" (ParallelGzipWriter), "zstd" (needs the optional zstandard package), or None
+    """
+    if compression == 'gzip':
+        return ParallelGzipWriter(path, level=level, threads=threads)
+    if compression == 'zstd':
+        import zstandard
+        cctx = zstandard.ZstdCompressor(level=level, threads=threads or -1)
+        return cctx.stream_writer(open(path, 'wb'), closefd=True)
+    if compression is None:
+        return open(path, 'wb')
+    raise ValueError('Unknown compression %s' % compression)
+
+
+# File extension added by open_compressed_writer for each compression
+COMPRESSION_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst', None: ''}
+
+
 class Stopwatch:
     """
     Usage:
@@ -205,6 +689,65 @@ class Stopwatch:
         sys.stdout.flush()
 
 
+def reset_peak_rss():
+    """Reset the peak resident set size of this process (Linux only; elsewhere the peak covers the process lifetime)"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process, since the last reset_peak_rss where supported"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+# The peak is reset for the whole process, so stages measured in threads of one process run one at a time
+_peak_rss_lock = threading.Lock()
+
+
+def _reset_peak_rss_lock():
+    global _peak_rss_lock
+    _peak_rss_lock = threading.Lock()
+
+
+# A process forked while another thread measures a stage must not inherit the held lock
+os.register_at_fork(after_in_child=_reset_peak_rss_lock)
+
+
+class PeakRss:
+    """
+    Log the peak resident set size of this process during a stage
+    Stages in other threads of the same process wait, so that they do not reset each other's peaks
+    ...(stages in the workers of a process pool are measured in parallel, one per process)
+    Usage:
+        with PeakRss('Merging records'):
+            merge()
+    """
+    def __init__(self, name):
+        self.name = name
+    def __enter__(self):
+        _peak_rss_lock.acquire()
+        reset_peak_rss()
+    def __exit__(self, type, value, traceback):
+        try:
+            sys.stdout.write('%s peak RSS %.1f MB (pid %d)\n' % (self.name, peak_rss_bytes() / 1e6, os.getpid()))
+            sys.stdout.flush()
+        finally:
+            _peak_rss_lock.release()
+
+
 def sleep_until_next_period(period, offset=0):
     now = time.time()
     start_of_next_period = math.ceil((now - offset) / period) * period + offset
@@ -0,0 +1,305 @@
+"""
+Lease-based job queue in a folder on the shared filesystem, which workers on several hosts pull jobs from
+Each job is a JSON file that moves between state folders with os.rename, which is atomic, so one worker wins:
+    pending/ -> leased/ (a worker took the job) -> done/ (or back to pending/ on failure, or failed/)
+In leased/ the file is named after its worker (<workerId>~<jobId>.json), so a worker only ever renames its own lease
+A worker touches its leased file every heartbeatSecs; a leased file whose heartbeat is older than leaseTimeoutSecs
+...belongs to a dead or stuck worker, and reclaimStale moves it back to pending/ (or to failed/ after maxAttempts)
+A job only starts when the jobs in its deps are done (e.g., the bin file of a date after the HYSPLIT runs of the date)
+Jobs are leased in the sorted order of their ids
+Only the worker that holds the lease can move a job to done/ (the rename of its leased file fails once the lease
+...was reclaimed), and a worker that loses its lease is cancelled,
+...but a job can still run twice (e.g., after a long pause), so jobs must publish their results atomically
+...(like CachedDispersionRun.run and create_multisource_bin do) to publish them exactly once
+
+Usage:
+    queue = WorkQueue('data/work_queue/')
+    queue.enqueue('20230702_1_run', 'hysplit', {'date': '2023-07-02 00:00'})
+    queue.enqueue('20230702_2_bin', 'bin', {'date': '2023-07-02 00:00'}, deps=['20230702_1_run'])
+    queue.work({'hysplit': runJob, 'bin': binJob}) # in one or more processes on each host, fn(args, cancelEvent)
+
+    python work_queue_lib.py status [queueDir]
+    python work_queue_lib.py retry_failed [queueDir]
+"""
+
+
+import os, sys, json, time, socket, threading, traceback
+
+
+STATES = ['pending', 'leased', 'done', 'failed']
+DEFAULT_QUEUE_DIR = 'data/work_queue/'
+# Separates the worker id from the job id in the names of leased files (host names and pids have no "~")
+LEASE_SEPARATOR = '~'
+# Suffix of a leased file that its worker is moving to pending/ or failed/ (see fail)
+CLAIM_SUFFIX = '.claim'
+
+
+class LostLease(Exception):
+    """The lease of a job was reclaimed by another worker"""
+    pass
+
+
+class WorkQueue:
+    def __init__(self, queueDir=DEFAULT_QUEUE_DIR, leaseTimeoutSecs=600, heartbeatSecs=30, maxAttempts=3):
+        self.queueDir = queueDir
+        self.leaseTimeoutSecs = leaseTimeoutSecs
+        self.heartbeatSecs = heartbeatSecs
+        self.maxAttempts = maxAttempts
+        self.workerId = '%s_%d' % (socket.gethostname(), os.getpid())
+        for state in STATES:
+            os.makedirs(os.path.join(queueDir, state), exist_ok=True)
+
+    def jobPath(self, state, jobId):
+        return os.path.join(self.queueDir, state, jobId + '.json')
+
+    def leasedPath(self, jobId, workerId=None):
+        """The file of a job leased by workerId (this worker by default)"""
+        return os.path.join(self.queueDir, 'leased', '%s%s%s.json' % (workerId or self.workerId, LEASE_SEPARATOR, jobId))
+
+    def leases(self):
+        """(jobId, path) of the leased files of all workers, including the ones being moved by fail"""
+        leases = []
+        for name in os.listdir(os.path.join(self.queueDir, 'leased')):
+            rest = name.partition(LEASE_SEPARATOR)[2]
+            for suffix in ['.json', '.json' + CLAIM_SUFFIX]:
+                if rest.endswith(suffix):
+                    leases.append((rest[:-len(suffix)], os.path.join(self.queueDir, 'leased', name)))
+        return sorted(leases)
+
+    def state(self, jobId):
+        """The state folder of a job, or None if it was never queued"""
+        for state in STATES:
+            if state == 'leased':
+                if any(leasedId == jobId for leasedId, path in self.leases()):
+                    return state
+            elif os.path.exists(self.jobPath(state, jobId)):
+                return state
+        return None
+
+    def jobIds(self, state):
+        if state == 'leased':
+            return sorted(set(jobId for jobId, path in self.leases()))
+        return sorted(name[:-len('.json')] for name in os.listdir(os.path.join(self.queueDir, state))
+                if name.endswith('.json'))
+
+    def counts(self):
+        return {state: len(self.jobIds(state)) for state in STATES}
+
+    def writeJob(self, path, job):
+        tmpPath = '%s_%s_%d.tmp' % (path, self.workerId, threading.get_ident())
+        with open(tmpPath, 'w') as f:
+            json.dump(job, f)
+        os.rename(tmpPath, path)
+
+    def readJob(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            # Moved by another worker
+            return None
+
+    def enqueue(self, jobId, kind, args, deps=()):
+        """
+        Add a job unless a job with the same id was already queued (in any state)
+        Input:
+            jobId: a file name without "/", which sets the order of the jobs
+            kind: the key of the handler that runs the job (see work)
+            args: JSON-serializable arguments of the handler
+            deps: ids of the jobs that must be done first
+        Output:
+            True if the job was added
+        """
+        assert('/' not in jobId)
+        if self.state(jobId) is not None:
+            return False
+        self.writeJob(self.jobPath('pending', jobId), {'id': jobId, 'kind': kind, 'args': args, 'deps': list(deps),
+            'attempts': 0, 'worker': None, 'error': None, 'enqueuedAt': time.time()})
+        return True
+
+    def lease(self):
+        """Take the first pending job whose deps are done, or return None"""
+        leasedIds = self.reclaimStale()
+        pendingIds = self.jobIds('pending')
+        # Listed once per call, in the order jobs move through the states, so that a moving job is seen at least once
+        stateIds = {'pending': set(pendingIds), 'leased': leasedIds,
+                    'done': set(self.jobIds('done')), 'failed': set(self.jobIds('failed'))}
+
+        def depState(dep):
+            for state in STATES:
+                if dep in stateIds[state]:
+                    return state
+            # Moved back to pending after it was listed, or never queued
+            return self.state(dep)
+
+        for jobId in pendingIds:
+            pendingPath = self.jobPath('pending', jobId)
+            job = self.readJob(pendingPath)
+            if job is None:
+                continue
+            depStates = [depState(dep) for dep in job['deps']]
+            if any(state in ['failed', None] for state in depStates):
+                # The job can never run
+                self.moveJob(pendingPath, 'failed', jobId, 'a dependency failed or was never queued')
+                continue
+            if any(state != 'done' for state in depStates):
+                continue
+            leasedPath = self.leasedPath(jobId)
+            try:
+                # Touch first, so that the moved file does not look stale to reclaimStale
+                os.utime(pendingPath)
+                os.rename(pendingPath, leasedPath)
+            except FileNotFoundError:
+                # Another worker took it
+                continue
+            job['attempts'] += 1
+            job['worker'] = self.workerId
+            job['leasedAt'] = time.time()
+            self.writeJob(leasedPath, job)
+            return job
+        return None
+
+    def moveJob(self, path, state, jobId, error):
+        try:
+            os.rename(path, self.jobPath(state, jobId))
+            sys.stdout.write('Job %s moved to %s: %s\n' % (jobId, state, error))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def heartbeat(self, job):
+        """Extend the lease of job; raises LostLease if it was reclaimed"""
+        try:
+            os.utime(self.leasedPath(job['id']))
+        except FileNotFoundError:
+            raise LostLease('Lost the lease of job %s' % job['id'])
+
+    def complete(self, job):
+        """Move a leased job to done; raises LostLease if it was reclaimed"""
+        try:
+            # Only this worker renames its leased file, and the rename fails if reclaimStale moved it
+            os.rename(self.leasedPath(job['id']), self.jobPath('done', job['id']))
+        except FileNotFoundError:
+            raise LostLease('Lost the lease of job %s' % job['id'])
+
+    def fail(self, job, error):
+        """Queue a leased job again, or move it to failed after maxAttempts"""
+        leasedPath = self.leasedPath(job['id'])
+        claimPath = leasedPath + CLAIM_SUFFIX
+        try:
+            # Claim the lease first, so that reclaimStale cannot move it while its error is written
+            os.rename(leasedPath, claimPath)
+        except FileNotFoundError:
+            return
+        job['error'] = error
+        job['worker'] = None
+        self.writeJob(claimPath, job)
+        self.moveJob(claimPath, 'failed' if job['attempts'] >= self.maxAttempts else 'pending', job['id'], error)
+
+    def reclaimStale(self):
+        """
+        Move the jobs whose lease expired (their worker died or hung) back to pending, or to failed
+        Output:
+            the set of ids of the jobs that are still leased
+        """
+        cutoff = time.time() - self.leaseTimeoutSecs
+        leasedIds = set()
+        # Claimed files are reclaimed too, in case their worker died in fail
+        for jobId, leasedPath in self.leases():
+            leasedIds.add(jobId)
+            try:
+                if os.path.getmtime(leasedPath) > cutoff:
+                    continue
+            except OSError:
+                continue
+            job = self.readJob(leasedPath)
+            if job is None:
+                continue
+            # One rename, so that a reclaimed job cannot be leased before it reaches its final state
+            state = 'failed' if job['attempts'] >= self.maxAttempts else 'pending'
+            if self.moveJob(leasedPath, state, jobId, 'the lease of worker %s expired' % job['worker']):
+                leasedIds.discard(jobId)
+        return leasedIds
+
+    def retryFailed(self):
+        """Queue the failed jobs again, with their attempts reset"""
+        for jobId in self.jobIds('failed'):
+            failedPath = self.jobPath('failed', jobId)
+            job = self.readJob(failedPath)
+            if job is None:
+                continue
+            job['attempts'] = 0
+            self.writeJob(failedPath, job)
+            self.moveJob(failedPath, 'pending', jobId, 'retrying')
+
+    def runJob(self, job, handler):
+        """Run one leased job with a heartbeat thread that cancels it if the lease is lost"""
+        cancelEvent = threading.Event()
+        finished = threading.Event()
+
+        def beat():
+            while not finished.wait(self.heartbeatSecs):
+                try:
+                    self.heartbeat(job)
+                except LostLease as e:
+                    sys.stderr.write('%s, cancelling it\n' % e)
+                    cancelEvent.set()
+                    return
+
+        heartbeatThread = threading.Thread(target=beat, daemon=True)
+        heartbeatThread.start()
+        try:
+            handler(job['args'], cancelEvent)
+        finally:
+            finished.set()
+            heartbeatThread.join()
+        if cancelEvent.is_set():
+            raise LostLease('Lost the lease of job %s' % job['id'])
+
+    def work(self, handlers, stopWhenEmpty=True, pollSecs=30):
+        """
+        Lease and run jobs until the queue is empty (or forever if stopWhenEmpty is False)
+        Input:
+            handlers: a dict from job kind to fn(args, cancelEvent), which raises if the job failed
+        Output:
+            the number of jobs completed by this worker
+        """
+        completed = 0
+        while True:
+            job = self.lease()
+            if job is None:
+                counts = self.counts()
+                if stopWhenEmpty and counts['pending'] == 0 and counts['leased'] == 0:
+                    break
+                time.sleep(pollSecs)
+                continue
+            sys.stdout.write('Worker %s running job %s (attempt %d)\n' % (self.workerId, job['id'], job['attempts']))
+            try:
+                self.runJob(job, handlers[job['kind']])
+                self.complete(job)
+                completed += 1
+            except LostLease as e:
+                sys.stderr.write('%s\n' % e)
+            except Exception:
+                traceback.print_exc()
+                self.fail(job, traceback.format_exc(limit=3))
+        sys.stdout.write('Worker %s completed %d jobs, queue %s\n' % (self.workerId, completed, self.counts()))
+        return completed
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in ['status', 'retry_failed']:
+        print(__doc__)
+        return
+    queue = WorkQueue(argv[2] if len(argv) > 2 else DEFAULT_QUEUE_DIR)
+    if argv[1] == 'retry_failed':
+        queue.retryFailed()
+    print(queue.counts())
+    for jobId, leasedPath in queue.leases():
+        job = queue.readJob(leasedPath)
+        if job is not None:
+            print('%s leased by %s' % (jobId, job['worker']))
+
+
+if __name__ == '__main__':
+    main(sys.argv)